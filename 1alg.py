@@ -1,8 +1,154 @@
-from collections import defaultdict
+import re
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from math import comb, log2
+from weakref import WeakValueDictionary
 
 err = ValueError("Недопустимое выражение")
 
 
+class LimitError(ValueError):
+    """
+    Выражение допустимо, но его степень или результат превышают пределы (MAX_POWER, EXPONENT_BITS и т.п.)
+    """
+
+
+limit_err = LimitError("Слишком большая степень")
+VARIABLES = ('x', 'y', 'z')
+# Одночлен хранится одним числом: степени x, y, z по EXPONENT_BITS бит,
+# так что произведение одночленов - сумма их ключей
+EXPONENT_BITS = 21
+EXPONENT_MASK = (1 << EXPONENT_BITS) - 1
+VARIABLE_KEYS = {var: 1 << (EXPONENT_BITS * i) for i, var in enumerate(VARIABLES)}
+# Старшие биты степеней: если их нет ни в одном ключе множителей, сумма ключей не переполняется
+EXPONENT_HIGH_BITS = sum(1 << (EXPONENT_BITS * (i + 1) - 1) for i in range(len(VARIABLES)))
+# Сколько скомпилированных выражений хранит get_evaluator
+EVALUATOR_CACHE_SIZE = 1024
+# Сколько результатов хранит algebra_calc_batch
+RESULT_CACHE_SIZE = 65536
+# Сколько скобок (их токенов) и результатов операций над общими выражениями помнит парсер,
+# и скобки какой длины в токенах стоит искать в кэше
+SPAN_CACHE_SIZE = 4096
+OPERATION_CACHE_SIZE = 4096
+SPAN_CACHE_TOKENS = 64
+# Результаты длиннее стольких термов не запоминаются
+OPERATION_CACHE_TERMS = 1024
+# Пределы степени: число после '^', бит в коэффициентах результата (str() печатает до 4300 цифр)
+# и оценка числа умножений одночленов (см. power_costs), около секунды
+MAX_POWER = 10000
+MAX_POWER_BITS = 14000
+MAX_POWER_COST = 4 * 10 ** 6
+
+
+def power_costs(items, power):
+    """
+    Оценивает число умножений одночленов для (сумма items) ^ power.
+    Размер степени i ограничен и числом разбиений i между термами, и числом одночленов её степени.
+    :param items: Пары (ключ одночлена, коэффициент) основания
+    :return: Способ -> оценка
+    """
+    terms = len(items)
+    degree = max(sum(exponents(key)) for key, _ in items)
+    used = sum(1 for i in range(len(VARIABLES)) if any(exponents(key)[i] for key, _ in items))
+
+    def size(i):
+        return min(comb(i + terms - 1, terms - 1), comb(i * degree + used, used))
+
+    squaring = 0
+    result, base, rest = 0, 1, power
+    while rest:
+        if rest & 1:
+            squaring += size(result) * size(base)
+            result += base
+        rest >>= 1
+        if rest:
+            squaring += size(base) ** 2
+            base *= 2
+    return {
+        "multinomial": comb(power + terms - 1, terms - 1) * terms,
+        "chain": terms * sum(size(i) for i in range(1, power)),
+        "squaring": squaring,
+    }
+
+
+def multinomial_power(items, power):
+    """
+    (c1 * m1 + ... + ck * mk) ^ n по полиномиальной формуле:
+    сумма n! / (j1! ... jk!) * c1^j1 ... ck^jk * m1^j1 ... mk^jk по всем j1 + ... + jk = n
+    :param items: Пары (ключ одночлена, коэффициент)
+    :return: Выражение (type Expression)
+    """
+    factorials = [1]
+    for i in range(1, power + 1):
+        factorials.append(factorials[-1] * i)
+    coeff_powers = [[coeff ** j for j in range(power + 1)] for _, coeff in items]
+    last = len(items) - 1
+    result = Expression()
+    terms = result.terms
+    # Номер терма, остаток степени, ключ и коэффициент произведения, произведение факториалов
+    stack = [(0, power, 0, 1, 1)]
+    while stack:
+        i, rest, key, coeff, denominator = stack.pop()
+        item_key = items[i][0]
+        if i == last:
+            terms[key + item_key * rest] += (factorials[power] // (denominator * factorials[rest])
+                                             * coeff * coeff_powers[i][rest])
+            continue
+        for j in range(rest + 1):
+            stack.append((i + 1, rest - j, key + item_key * j, coeff * coeff_powers[i][j],
+                          denominator * factorials[j]))
+    return result.drop_zeros()
+
+
+def monomial_key(variables):
+    """
+    :param variables: Кортеж переменных одночлена, например ('x', 'x', 'y')
+    :return: Ключ одночлена
+    """
+    return sum(VARIABLE_KEYS[var] for var in variables)
+
+
+def exponents(key):
+    """
+    :return: Степени (x, y, z) одночлена
+    """
+    return tuple((key >> (EXPONENT_BITS * i)) & EXPONENT_MASK for i in range(len(VARIABLES)))
+
+
+def max_exponents(keys):
+    """
+    :param keys: Ключи одночленов
+    :return: Наибольшие степени (x, y, z) среди них
+    """
+    return tuple(max(powers) for powers in zip(*map(exponents, keys))) or (0,) * len(VARIABLES)
+
+
+def check_product(keys1, keys2):
+    """
+    Проверяет, что степени произведений одночленов keys1 на одночлены keys2 помещаются в EXPONENT_BITS бит:
+    иначе сумма ключей перенесла бы лишний разряд в степень следующей переменной
+    :raises LimitError: если степень произведения слишком велика
+    """
+    bits = 0
+    for key in keys1:
+        bits |= key
+    for key in keys2:
+        bits |= key
+    if not bits & EXPONENT_HIGH_BITS:
+        return
+    if any(a + b > EXPONENT_MASK for a, b in zip(max_exponents(keys1), max_exponents(keys2))):
+        raise limit_err
+
+
+def monomial_variables(key):
+    """
+    :return: Отсортированный кортеж переменных одночлена, например ('x', 'x', 'y')
+    """
+    return tuple(var for var, power in zip(VARIABLES, exponents(key)) for _ in range(power))
+
+
 class Term:
     def __init__(self, coefficient, variables):
         self.coefficient = coefficient
@@ -28,48 +174,179 @@ class Term:
 
 class Expression:
     def __init__(self):
-        self.terms = defaultdict(int)  # Терм -> Коэффицент
+        self.terms = defaultdict(int)  # Ключ одночлена (см. monomial_key) -> Коэффицент
+        self._key = None  # frozenset термов, когда выражение заморожено (см. intern)
+
+    def key(self):
+        """
+        Неизменяемое представление значения: frozenset пар (ключ одночлена, коэффициент) без нулей
+        """
+        if self._key is not None:
+            return self._key
+        return frozenset((key, coeff) for key, coeff in self.terms.items() if coeff != 0)
+
+    def intern(self):
+        """
+        Замораживает выражение и возвращает общий экземпляр с тем же значением.
+        Замороженное выражение хешируется и не меняется: += и -= возвращают новое,
+        а +, - и * над двумя замороженными запоминаются в OPERATION_CACHE
+        """
+        if self._key is None:
+            self.drop_zeros()
+            self._key = frozenset(self.terms.items())
+        return INTERNED.setdefault(self._key, self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Expression):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __hash__(self):
+        if self._key is None:
+            raise TypeError("Изменяемое Expression не хешируется, см. intern")
+        return hash(self._key)
+
+    def operation_key(self, op, other):
+        """
+        Ключ OPERATION_CACHE для self op other, либо None, если один из операндов не заморожен
+        """
+        if self._key is None or other._key is None:
+            return None
+        return op, self._key, other._key
 
     def add_term(self, term):
-        key = term.variables
+        if self._key is not None:
+            raise TypeError("Замороженное Expression не меняется")
+        key = monomial_key(term.variables)
         self.terms[key] += term.coefficient
 
+    def drop_zeros(self):
+        """
+        Удаляет нулевые коэффициенты на месте
+        """
+        for key in [key for key, coeff in self.terms.items() if coeff == 0]:
+            del self.terms[key]
+        return self
+
     def simplify(self):
         simplified = Expression()
-        for vars_, coeff in self.terms.items():
-            if coeff != 0:
-                simplified.terms[vars_] = coeff
-        return simplified
+        simplified.terms.update(self.terms)
+        return simplified.drop_zeros()
 
-    def __add__(self, other):
+    def copy(self):
         result = Expression()
-        for vars_, coeff in self.terms.items():
-            result.terms[vars_] += coeff
-        for vars_, coeff in other.terms.items():
-            result.terms[vars_] += coeff
-        return result.simplify()
+        result.terms.update(self.terms)
+        return result
+
+    def __iadd__(self, other):
+        if self._key is not None:
+            # Замороженное выражение общее, меняем копию
+            self = self.copy()
+        terms = self.terms
+        for key, coeff in other.terms.items():
+            terms[key] += coeff
+        return self.drop_zeros()
+
+    def __isub__(self, other):
+        if self._key is not None:
+            self = self.copy()
+        terms = self.terms
+        for key, coeff in other.terms.items():
+            terms[key] -= coeff
+        return self.drop_zeros()
+
+    def __add__(self, other):
+        key = self.operation_key('+', other)
+        if key is not None:
+            cached = OPERATION_CACHE.get(key)
+            if cached is not None:
+                return cached
+        result = self.copy()
+        result += other
+        return remember(key, result)
 
     def __sub__(self, other):
-        result = Expression()
-        for vars_, coeff in self.terms.items():
-            result.terms[vars_] += coeff
-        for vars_, coeff in other.terms.items():
-            result.terms[vars_] -= coeff
-        return result.simplify()
+        key = self.operation_key('-', other)
+        if key is not None:
+            cached = OPERATION_CACHE.get(key)
+            if cached is not None:
+                return cached
+        result = self.copy()
+        result -= other
+        return remember(key, result)
 
     def __mul__(self, other):
+        key = self.operation_key('*', other)
+        if key is not None:
+            cached = OPERATION_CACHE.get(key)
+            if cached is not None:
+                return cached
+        check_product(self.terms, other.terms)
         result = Expression()
-        for vars1, coeff1 in self.terms.items():
-            for vars2, coeff2 in other.terms.items():
-                combined_vars = tuple(sorted(vars1 + vars2))
-                total_coeff = coeff1 * coeff2
-                result.terms[combined_vars] += total_coeff
-        return result.simplify()
+        terms = result.terms
+        other_terms = list(other.terms.items())
+        for key1, coeff1 in self.terms.items():
+            for key2, coeff2 in other_terms:
+                terms[key1 + key2] += coeff1 * coeff2
+        return remember(key, result.drop_zeros())
+
+    def __pow__(self, power):
+        """
+        Возведение в неотрицательную целую степень. Из трёх способов выбирается самый дешёвый
+        по оценке числа умножений одночленов (см. power_costs):
+        полиномиальная формула - один проход по разбиениям степени между термами,
+        возведение в квадрат - O(log power) умножений многочленов,
+        последовательное умножение на основание - power - 1 умножений на короткий многочлен.
+        :raises LimitError: если степень одночлена не поместится в EXPONENT_BITS бит
+            или результат превысит MAX_POWER_BITS / MAX_POWER_COST
+        """
+        if power < 0:
+            raise err
+        items = [(key, coeff) for key, coeff in self.terms.items() if coeff != 0]
+        result = Expression()
+        if power == 0:
+            result.terms[0] = 1
+            return result
+        if power == 1:
+            result.terms.update(items)
+            return result
+        if not items:
+            return result
+        if max(max_exponents(key for key, _ in items)) * power > EXPONENT_MASK:
+            raise limit_err
+        # Коэффициенты результата не больше (|c1| + ... + |ck|) ^ power
+        if power * log2(sum(abs(coeff) for _, coeff in items)) > MAX_POWER_BITS:
+            raise limit_err
+        if len(items) == 1:
+            for key, coeff in items:
+                result.terms[key * power] = coeff ** power
+            return result
+
+        costs = power_costs(items, power)
+        method = min(costs, key=costs.get)
+        if costs[method] > MAX_POWER_COST:
+            raise limit_err
+        if method == "multinomial":
+            return multinomial_power(items, power)
+        result.terms[0] = 1
+        base = self
+        if method == "chain":
+            for _ in range(power):
+                result = result * base
+            return result
+        while power:
+            if power & 1:
+                result = result * base
+            power >>= 1
+            if power:
+                base = base * base
+        return result
 
     def __str__(self):
         parts = []
         # Сортируем по самому длинному ключу
-        for vars_, coeff in sorted(self.terms.items(), key=lambda x: (-len(x[0]), x[0])):
+        monomials = [(monomial_variables(key), coeff) for key, coeff in self.terms.items()]
+        for vars_, coeff in sorted(monomials, key=lambda x: (-len(x[0]), x[0])):
             term = Term(coeff, vars_)
             parts.append(str(term))
         if not parts:
@@ -77,89 +354,187 @@ class Expression:
         return " + ".join(parts)
 
 
-def parse_expression(tokens, pos=0):
+def remember(key, result):
     """
-    Парсер токенов выражения
-    :param tokens: Массив токенов
-    :param pos: Текущий номер токена
-    :return: Выражение (type Expression) и позицию
+    Запоминает результат операции над замороженными выражениями (замораживая и его)
+    :param key: Ключ из Expression.operation_key или None
+    :return: result или его общий экземпляр
     """
-    if pos >= len(tokens):
-        raise err
-    expr, pos = parse_additive(tokens, pos)
-    return expr, pos
+    if key is None or len(result.terms) > OPERATION_CACHE_TERMS:
+        return result
+    result = result.intern()
+    OPERATION_CACHE.put(key, result)
+    return result
+
+
+def cache_stats():
+    """
+    Попадания и промахи кэшей парсера
+    :return: {'spans': {...}, 'operations': {...}, 'interned': кол-во общих выражений}
+    """
+    return {
+        'spans': {'hits': SPAN_CACHE.hits, 'misses': SPAN_CACHE.misses, 'size': len(SPAN_CACHE.items)},
+        'operations': {'hits': OPERATION_CACHE.hits, 'misses': OPERATION_CACHE.misses,
+                       'size': len(OPERATION_CACHE.items)},
+        'interned': len(INTERNED),
+    }
+
 
+def clear_caches():
+    SPAN_CACHE.clear()
+    OPERATION_CACHE.clear()
 
-def parse_additive(tokens, pos):
+
+def match_parentheses(tokens):
     """
-    Обработчик аддитивных операция
     :param tokens: Массив токенов
-    :param pos: Текущий номер токена
-    :return: Выражение (type Expression) и позицию
+    :return: Номер открывающей скобки -> номер парной ей закрывающей
     """
-    left_expr, pos = parse_multiplicative(tokens, pos)
-    while pos < len(tokens) and tokens[pos] in ('+', '-'):
-        op = tokens[pos]
-        pos += 1
-        right_expr, pos = parse_multiplicative(tokens, pos)
-        if op == '+':
-            left_expr = left_expr + right_expr
-        else:
-            left_expr = left_expr - right_expr
-    return left_expr, pos
+    closing = {}
+    opened = []
+    for i, token in enumerate(tokens):
+        if token == '(':
+            opened.append(i)
+        elif token == ')' and opened:
+            closing[opened.pop()] = i
+    return closing
 
 
-def parse_multiplicative(tokens, pos):
+def parse_power(tokens, pos, expr):
     """
-    Обработчик умножения
+    Возводит expr в степень, если за ним идёт '^' и целое число не больше MAX_POWER
     :param tokens: Массив токенов
-    :param pos: Текущий номер токена
+    :param pos: Номер токена после expr
     :return: Выражение (type Expression) и позицию
     """
-    left_expr, pos = parse_primary(tokens, pos)
-    while pos < len(tokens) and tokens[pos] == '*':
-        pos += 1
-        right_expr, pos = parse_primary(tokens, pos)
-        left_expr = left_expr * right_expr
-    return left_expr, pos
+    if pos < len(tokens) and tokens[pos] == '^':
+        if pos + 1 >= len(tokens) or not tokens[pos + 1].isdigit():
+            raise err
+        power = int(tokens[pos + 1])
+        if power > MAX_POWER:
+            raise limit_err
+        return expr ** power, pos + 2
+    return expr, pos
 
 
-def parse_primary(tokens, pos):
+def parse_operand(tokens, pos):
     """
-    Обработчик термов и компоновщик цифр в числа
+    Разбирает переменную или число (возможно, с минусом) со степенью
     :param tokens: Массив токенов
     :param pos: Текущий номер токена
-    :return: Выражение (type Expression) и позицию
+    :return: Выражение (type Expression) и позицию, либо None и pos, если там не операнд
     """
     token = tokens[pos]
     expr = Expression()
     if token in ('x', 'y', 'z'):
-        term = Term(1, (token,))
-        expr.add_term(term)
-        pos += 1
-        return expr, pos
+        expr.add_term(Term(1, (token,)))
+        return parse_power(tokens, pos + 1, expr)
     elif token.isdigit() or (token == '-' and pos + 1 < len(tokens) and tokens[pos + 1].isdigit()):
         if token == '-':
-            sign = -1
-            pos += 1
-            number = tokens[pos]
-            pos += 1
-            coeff = sign * int(number)
+            # -2 ^ 2 = -(2 ^ 2)
+            expr.add_term(Term(int(tokens[pos + 1]), tuple()))
+            expr, pos = parse_power(tokens, pos + 2, expr)
+            return Expression() - expr, pos
+        expr.add_term(Term(int(token), tuple()))
+        return parse_power(tokens, pos + 1, expr)
+    return None, pos
+
+
+def apply_operator(operands, op):
+    right_expr = operands.pop()
+    if op == '*':
+        operands[-1] = operands[-1] * right_expr
+    elif operands[-1]._key is not None and right_expr._key is not None:
+        # Оба операнда заморожены: сумма и разность берутся из OPERATION_CACHE
+        operands[-1] = operands[-1] + right_expr if op == '+' else operands[-1] - right_expr
+    elif op == '+':
+        operands[-1] += right_expr
+    else:
+        operands[-1] -= right_expr
+
+
+def parse_expression(tokens, pos=0):
+    """
+    Парсер токенов выражения на явных стеках, без рекурсии: глубина скобок не ограничена.
+    Степень ('^' или '**' и целое число) связывает сильнее умножения и относится к операнду или скобкам.
+    Разбор останавливается на лишней закрывающей скобке или неожиданном токене вне скобок.
+    Короткие скобки ищутся в SPAN_CACHE по своим токенам, а их значения замораживаются
+    (см. Expression.intern): повторная скобка не разбирается и не перемножается заново.
+    :param tokens: Массив токенов
+    :param pos: Текущий номер токена
+    :return: Выражение (type Expression) и позицию
+    """
+    if pos >= len(tokens):
+        raise err
+    operands = []
+    # Операторы '+', '-', '*' и открытые скобки '('
+    operators = []
+    # Ключи SPAN_CACHE открытых скобок (None для длинных)
+    spans = []
+    closing = match_parentheses(tokens)
+    depth = 0
+    while True:
+        # Ожидается операнд
+        if pos >= len(tokens):
+            if operators and operators[-1] != '(':
+                # Выражение оборвалось после оператора, как tokens[pos] в рекурсивном парсере
+                raise IndexError("list index out of range")
+            raise err
+        if tokens[pos] == '(':
+            end = closing.get(pos)
+            key = None
+            if end is not None and end - pos < SPAN_CACHE_TOKENS:
+                key = tuple(tokens[pos:end + 1])
+                expr = SPAN_CACHE.get(key)
+            if key is None or expr is None:
+                operators.append('(')
+                spans.append(key)
+                depth += 1
+                pos += 1
+                continue
+            expr, pos = parse_power(tokens, end + 1, expr)
         else:
-            coeff = int(token)
+            expr, pos = parse_operand(tokens, pos)
+            if expr is None:
+                raise err
+        operands.append(expr)
+
+        # Ожидается оператор; '*' связывает сильнее '+' и '-', все левоассоциативны
+        while True:
+            token = tokens[pos] if pos < len(tokens) else None
+            if token == ')' and depth:
+                while operators[-1] != '(':
+                    apply_operator(operands, operators.pop())
+                operators.pop()
+                depth -= 1
+                group = operands[-1]
+                key = spans.pop()
+                if key is not None:
+                    group = group.intern()
+                    SPAN_CACHE.put(key, group)
+                operands[-1], pos = parse_power(tokens, pos + 1, group)
+                continue
+            break
+        if token in ('+', '-', '*'):
+            while operators and operators[-1] != '(' and (token != '*' or operators[-1] == '*'):
+                apply_operator(operands, operators.pop())
+            operators.append(token)
             pos += 1
-        term = Term(coeff, tuple())
-        expr.add_term(term)
-        return expr, pos
-    elif token == '(':
-        pos += 1
-        expr, pos = parse_expression(tokens, pos)
-        if pos >= len(tokens) or tokens[pos] != ')':
+            continue
+        if depth:
+            # Скобка не закрыта: конец выражения или неожиданный токен
             raise err
-        pos += 1
-        return expr, pos
-    else:
-        raise err
+        while operators:
+            apply_operator(operands, operators.pop())
+        return operands[0], pos
+
+
+def strip_spaces(expr_str):
+    """
+    Удаляет пробелы, заменив '**' на '^' до этого. Умножения через пробел ("* *") так и остаются
+    через пробел: иначе повторный разбор строки без пробелов прочёл бы их как степень
+    """
+    return re.sub(r'\*(?=\*)', '* ', expr_str.replace('**', '^').replace(' ', ''))
 
 
 def tokenize(expr_str):
@@ -168,12 +543,15 @@ def tokenize(expr_str):
     :param expr_str: Выражение
     :return: Массив токенов для упрощения
     """
-    expr_str = expr_str.replace(' ', '')
+    expr_str = strip_spaces(expr_str).replace(' ', '')
     tokens = []
     i = 0
     while i < len(expr_str):
         c = expr_str[i]
-        if c in "+-*()xyz":
+        if c == "^":
+            tokens.append("^")
+            i += 1
+        elif c in "+-*()xyz":
             tokens.append(c)
             if c == "-" and i + 1 < len(expr_str) and expr_str[i + 1] in "xyz":
                 # добавляем умножение на единичку перед пустой переменной для упрощения
@@ -192,6 +570,21 @@ def tokenize(expr_str):
     return tokens
 
 
+def parse(expr_str):
+    """
+    Разбивает выражение на токены и упрощает его
+    :param expr_str: Выражение (строка)
+    :return: Упрощённое выражение (type Expression)
+    :raises ValueError: если выражение недопустимо
+    :raises LimitError: если выражение допустимо, но слишком велико (это тоже ValueError)
+    """
+    tokens = tokenize(expr_str)
+    expr, pos = parse_expression(tokens)
+    if pos != len(tokens):
+        raise err
+    return expr
+
+
 def algebra_calc(expr_str):
     """
     Разбивает выражение на токены и упрощает его
@@ -199,17 +592,226 @@ def algebra_calc(expr_str):
     :return: Упрощённое выражение (строка)
     """
     try:
-        tokens = tokenize(expr_str)
-        expr, pos = parse_expression(tokens)
-        if pos != len(tokens):
-            return err.__str__()
-        return expr.__str__()
+        return parse(expr_str).__str__()
     except Exception as e:
         return e.__str__()
 
 
+def normalize(expr_str):
+    """
+    Выражение без пробелов по краям и внутри (см. strip_spaces): у таких строк одинаковый результат algebra_calc
+    """
+    return strip_spaces(expr_str.strip())
+
+
+def algebra_calc_many(expressions):
+    """
+    algebra_calc для списка выражений, задача для пула процессов
+    """
+    return [algebra_calc(expr_str) for expr_str in expressions]
+
+
+class LRUCache:
+    """
+    Словарь не больше max_size элементов, вытесняющий давно не использованные
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Общие замороженные выражения (живут, пока на них есть ссылки) и кэши парсера
+INTERNED = WeakValueDictionary()
+SPAN_CACHE = LRUCache(SPAN_CACHE_SIZE)
+OPERATION_CACHE = LRUCache(OPERATION_CACHE_SIZE)
+
+
+def algebra_calc_batch(lines, workers=None, chunk_size=1024, max_in_flight=None,
+                       cache_size=RESULT_CACHE_SIZE):
+    """
+    Упрощает поток выражений, возвращая результаты в порядке входа.
+    Повторы берутся из LRU-кэша, новые выражения частями по chunk_size считаются в пуле процессов.
+    :param lines: Выражения (строки), любой итерируемый объект
+    :param workers: Кол-во процессов; без него всё считается в текущем процессе
+    :param max_in_flight: Сколько частей одновременно в пуле, по умолчанию 2 * workers;
+        в памяти не больше (max_in_flight + 1) * chunk_size строк
+    :param cache_size: Размер кэша результатов
+    :return: Итератор упрощённых выражений (строк)
+    """
+    cache = LRUCache(cache_size)
+    # Список читался бы частями с начала снова и снова
+    lines = iter(lines)
+    chunks = iter(lambda: [normalize(line) for line in islice(lines, chunk_size)], [])
+    if not workers:
+        for chunk in chunks:
+            for key in chunk:
+                result = cache.get(key)
+                if result is None:
+                    result = algebra_calc(key)
+                    cache.put(key, result)
+                yield result
+        return
+
+    max_in_flight = max_in_flight or 2 * workers
+    # Выражения, уже отправленные в пул: повтор в следующей части не отправляется снова
+    in_flight = set()
+    pending = deque()
+
+    def emit(chunk, known, misses, future):
+        for key, result in zip(misses, future.result()):
+            known[key] = result
+            cache.put(key, result)
+        in_flight.difference_update(misses)
+        for key in chunk:
+            # Выражение из предыдущей части берётся из кэша: та часть только что выведена
+            result = known.get(key) or cache.get(key)
+            if result is None:
+                # Вытеснен из кэша до того, как дошла очередь
+                result = algebra_calc(key)
+                cache.put(key, result)
+            yield result
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks:
+            # Результаты, известные при отправке части
+            known = {}
+            misses = []
+            for key in chunk:
+                if key in known or key in in_flight:
+                    continue
+                result = cache.get(key)
+                if result is None:
+                    misses.append(key)
+                    in_flight.add(key)
+                else:
+                    known[key] = result
+            if len(pending) >= max_in_flight:
+                yield from emit(*pending.popleft())
+            pending.append((chunk, known, misses, pool.submit(algebra_calc_many, misses)))
+        while pending:
+            yield from emit(*pending.popleft())
+
+
+def power_code(var, power):
+    if power <= 3:
+        return " * ".join([var] * power)
+    return f"{var} ** {power}"
+
+
+def times_code(code, factor):
+    if code == "1":
+        return factor
+    if " + " in code:
+        code = f"({code})"
+    return f"{code} * {factor}"
+
+
+def horner_code(terms, depth=0):
+    """
+    Записывает многочлен по схеме Горнера: по x, коэффициенты при степенях x - по y, затем по z
+    :param terms: Степени (x, y, z)[depth:] -> коэффициент
+    :param depth: Номер текущей переменной
+    :return: Python-выражение от x, y, z
+    """
+    if depth == len(VARIABLES):
+        return str(terms.get((), 0))
+    var = VARIABLES[depth]
+    groups = defaultdict(dict)
+    for powers, coeff in terms.items():
+        groups[powers[0]][powers[1:]] = coeff
+    code = None
+    previous = None
+    for power in sorted(groups, reverse=True):
+        inner = horner_code(groups[power], depth + 1)
+        if code is None:
+            code = inner
+        else:
+            code = f"{times_code(code, power_code(var, previous - power))} + {inner}"
+        previous = power
+    if previous:
+        code = times_code(code, power_code(var, previous))
+    return code
+
+
+def compile_expression(expr):
+    """
+    Компилирует многочлен в функцию f(x=0, y=0, z=0) со схемой Горнера.
+    Аргументы - числа или массивы NumPy: операции поэлементные, поэтому одна функция
+    считает и одну точку, и миллионы точек за вызов.
+    :param expr: Выражение (type Expression)
+    :return: Функция от x, y, z
+    """
+    terms = {}
+    for key, coeff in expr.simplify().terms.items():
+        terms[exponents(key)] = coeff
+    code = horner_code(terms) if terms else "0"
+    if all(powers == (0, 0, 0) for powers in terms):
+        # Константа от массивов должна быть массивом той же формы
+        code = f"{code} + 0 * (x + y + z)"
+    namespace = {}
+    exec(f"def evaluate(x=0, y=0, z=0):\n    return {code}\n", namespace)
+    evaluate = namespace["evaluate"]
+    evaluate.code = code
+    return evaluate
+
+
+@lru_cache(maxsize=EVALUATOR_CACHE_SIZE)
+def compiled_evaluator(normalized):
+    return compile_expression(parse(normalized))
+
+
+def get_evaluator(expr_str):
+    """
+    Скомпилированная функция выражения из LRU-кэша.
+    Ключ кэша - выражение без пробелов, поэтому "x + 1" и "x+1" компилируются один раз.
+    :param expr_str: Выражение (строка)
+    :return: Функция f(x=0, y=0, z=0)
+    :raises ValueError: если выражение недопустимо
+    """
+    return compiled_evaluator(strip_spaces(expr_str))
+
+
 if __name__ == "__main__":
+    import argparse
     import sys
+
+    parser = argparse.ArgumentParser(description="Упрощение выражений из stdin")
+    parser.add_argument("--batch", action="store_true",
+                        help="только результаты, без проверочной таблицы, с кэшем повторов")
+    parser.add_argument("-j", "--workers", type=int, help="кол-во процессов для --batch")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="выражений в задаче пула")
+    parser.add_argument("--max-in-flight", type=int, help="задач одновременно в пуле")
+    parser.add_argument("--cache-size", type=int, default=RESULT_CACHE_SIZE, help="размер кэша результатов")
+    args = parser.parse_args()
+    if args.batch:
+        for result in algebra_calc_batch(sys.stdin, args.workers, args.chunk_size, args.max_in_flight,
+                                         args.cache_size):
+            sys.stdout.write(result + "\n")
+        sys.exit()
+
     test_inputs = [
         "2 * (3 * x + 4 * y) - 7 * y + 9",
         "z + z + 2 + 3 - 2 * z",
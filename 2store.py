@@ -1,5 +1,36 @@
+import asyncio
+import csv
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import date, timedelta, datetime
-from typing import List, Optional, Dict
+from itertools import islice
+from operator import itemgetter
+from threading import Lock, RLock
+from time import monotonic, perf_counter_ns
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from weakref import WeakSet
+
+# metrics.py лежит рядом: скрипт запускается из каталога репозитория или с ним в PYTHONPATH
+from metrics import METRICS
+
+try:
+    import numpy as np
+except ImportError:  # evaluate_carts работает и без numpy, но медленнее
+    np = None
+
+
+# Метрики пишутся, только когда METRICS.enabled (см. metrics.py)
+CART_REJECTIONS = METRICS.counter('cart_rejections_total', 'Отказы Cart.add_item по причинам', ('reason',))
+STORAGE_QUERY_SECONDS = METRICS.histogram('storage_query_seconds', 'Время запросов к Storage', ('query',))
 
 
 class Goods:
@@ -48,15 +79,18 @@ class Perishable(Goods):
     def expiration_date(self) -> date:
         return self.creation_date + timedelta(days=self.shelf_life_days)
 
-    def time_to_expire(self) -> timedelta:
+    def time_to_expire(self, now: Optional[datetime] = None) -> timedelta:
+        """
+        :param now: текущий момент, по умолчанию datetime.now()
+        """
         expiration_midnight = datetime.combine(self.expiration_date(), datetime.min.time())
-        return expiration_midnight - datetime.now()
+        return expiration_midnight - (now or datetime.now())
 
-    def is_expired(self) -> bool:
-        return self.time_to_expire() <= timedelta(0)
+    def is_expired(self, now: Optional[datetime] = None) -> bool:
+        return self.time_to_expire(now) <= timedelta(0)
 
-    def expires_in_less_than(self, delta: timedelta) -> bool:
-        return self.time_to_expire() < delta
+    def expires_in_less_than(self, delta: timedelta, now: Optional[datetime] = None) -> bool:
+        return self.time_to_expire(now) < delta
 
     def __str__(self):
         exp_date = self.expiration_date().strftime("%d-%m-%Y")
@@ -114,49 +148,1085 @@ class CombinedProduct(Goods):
         return "; ".join(parts)
 
 
+def _column(name: str) -> property:
+    """
+    Свойство представления, читающее и пишущее ячейку колонки Catalog
+    """
+
+    def get(self):
+        return getattr(self._catalog, name)[self._row]
+
+    def set(self, value):
+        getattr(self._catalog, name)[self._row] = value
+
+    return property(get, set)
+
+
+class _RowView:
+    """
+    Общая часть представлений строки Catalog: имя, цена и количество товара.
+    Представления одного вида одной строки равны, хотя каждое обращение создаёт новое.
+    """
+    __slots__ = ('_catalog', '_row')
+
+    def __init__(self, catalog: "Catalog", row: int):
+        self._catalog = catalog
+        self._row = row
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._catalog is other._catalog and self._row == other._row
+
+    def __hash__(self):
+        return hash((type(self), id(self._catalog), self._row))
+
+    name = property(lambda self: self._catalog.names[self._row])
+    price = _column('price')
+    quantity = _column('quantity')
+
+
+class FoodView(_RowView, Food):
+    proteins = _column('proteins')
+    fats = _column('fats')
+    carbs = _column('carbs')
+
+    @property
+    def calories(self):
+        # Колонка хранит float, а Food печатает калории как есть: целые отдаются целыми
+        calories = self._catalog.calories[self._row]
+        return int(calories) if self._catalog.flags[self._row] & Catalog.CALORIES_INT else calories
+
+    @calories.setter
+    def calories(self, value):
+        catalog, row = self._catalog, self._row
+        catalog.calories[row] = value
+        if isinstance(value, int):
+            catalog.flags[row] |= Catalog.CALORIES_INT
+        else:
+            catalog.flags[row] &= ~Catalog.CALORIES_INT
+
+
+class PerishableView(_RowView, Perishable):
+    creation_date = property(lambda self: date.fromordinal(self._catalog.creation_ordinal[self._row]))
+    shelf_life_days = _column('shelf_life_days')
+
+
+class VitaminsView(_RowView, Vitamins):
+    without_prescription = property(
+        lambda self: bool(self._catalog.flags[self._row] & Catalog.WITHOUT_PRESCRIPTION))
+
+
+class ProductView(_RowView, CombinedProduct):
+    """
+    Товар из Catalog с API CombinedProduct. Свойства food / perishable / vitamins
+    ссылаются на ту же строку, поэтому их name, price и quantity совпадают с товаром.
+    """
+
+    def _has(self, flag: int) -> bool:
+        return bool(self._catalog.flags[self._row] & flag)
+
+    def is_food(self):
+        return self._has(Catalog.FOOD)
+
+    def is_perishable(self):
+        return self._has(Catalog.PERISHABLE)
+
+    def is_vitamins(self):
+        return self._has(Catalog.VITAMINS)
+
+    @property
+    def food(self) -> Optional[FoodView]:
+        return FoodView(self._catalog, self._row) if self.is_food() else None
+
+    @property
+    def perishable(self) -> Optional[PerishableView]:
+        return PerishableView(self._catalog, self._row) if self.is_perishable() else None
+
+    @property
+    def vitamins(self) -> Optional[VitaminsView]:
+        return VitaminsView(self._catalog, self._row) if self.is_vitamins() else None
+
+
+class Catalog(Mapping):
+    """
+    Колоночное хранилище товаров: по массиву array на каждое поле и словарь имя -> строка.
+    Около 60 байт на товар плюс имя вместо четырёх объектов со своими __dict__.
+    По имени отдаётся ProductView с API CombinedProduct; удаление товаров не поддерживается.
+    """
+    FOOD = 1
+    PERISHABLE = 2
+    VITAMINS = 4
+    WITHOUT_PRESCRIPTION = 8
+    # Калории заданы целым числом (см. FoodView.calories)
+    CALORIES_INT = 16
+    COLUMNS = ('price', 'quantity', 'proteins', 'fats', 'carbs', 'calories',
+               'creation_ordinal', 'shelf_life_days', 'flags')
+
+    def __init__(self):
+        self.rows: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.price = array('d')
+        self.quantity = array('q')
+        self.proteins = array('d')
+        self.fats = array('d')
+        self.carbs = array('d')
+        self.calories = array('d')
+        # date.toordinal() даты изготовления, 0 если товар не скоропортящийся
+        self.creation_ordinal = array('l')
+        self.shelf_life_days = array('l')
+        self.flags = array('B')
+
+    @staticmethod
+    def _row_values(product: CombinedProduct) -> tuple:
+        flags = 0
+        proteins = fats = carbs = calories = 0.0
+        creation_ordinal = shelf_life_days = 0
+        if product.is_food():
+            flags |= Catalog.FOOD
+            food = product.food
+            proteins, fats, carbs, calories = food.proteins, food.fats, food.carbs, food.calories
+            if isinstance(calories, int):
+                flags |= Catalog.CALORIES_INT
+        if product.is_perishable():
+            flags |= Catalog.PERISHABLE
+            creation_ordinal = product.perishable.creation_date.toordinal()
+            shelf_life_days = product.perishable.shelf_life_days
+        if product.is_vitamins():
+            flags |= Catalog.VITAMINS
+            if product.vitamins.without_prescription:
+                flags |= Catalog.WITHOUT_PRESCRIPTION
+        return (product.price, product.quantity, proteins, fats, carbs, calories,
+                creation_ordinal, shelf_life_days, flags)
+
+    @staticmethod
+    def _row_product(name: str, values: Sequence) -> CombinedProduct:
+        """
+        Обратное к _row_values: отдельный CombinedProduct по значениям строки
+        """
+        price, quantity, proteins, fats, carbs, calories, creation_ordinal, shelf_life_days, flags = values
+        food = perishable = vitamins = None
+        if flags & Catalog.FOOD:
+            if flags & Catalog.CALORIES_INT:
+                calories = int(calories)
+            food = Food(name, price, quantity, proteins, fats, carbs, calories)
+        if flags & Catalog.PERISHABLE:
+            perishable = Perishable(name, price, quantity, date.fromordinal(creation_ordinal), shelf_life_days)
+        if flags & Catalog.VITAMINS:
+            vitamins = Vitamins(name, price, quantity, bool(flags & Catalog.WITHOUT_PRESCRIPTION))
+        return CombinedProduct(name, price, quantity, food=food, perishable=perishable, vitamins=vitamins)
+
+    def append_row(self, name: str, values: Sequence):
+        """
+        Добавляет новый товар значениями строки в порядке COLUMNS.
+        Если значение не помещается в колонку, каталог остаётся прежним.
+        """
+        row = len(self.names)
+        try:
+            for column, value in zip(self.COLUMNS, values):
+                getattr(self, column).append(value)
+        except (OverflowError, TypeError):
+            for column in self.COLUMNS:
+                del getattr(self, column)[row:]
+            raise
+        self.names.append(name)
+        self.rows[name] = row
+
+    def __setitem__(self, name: str, product: CombinedProduct):
+        values = self._row_values(product)
+        row = self.rows.get(name)
+        if row is None:
+            self.append_row(name, values)
+        else:
+            for column, value in zip(self.COLUMNS, values):
+                getattr(self, column)[row] = value
+
+    def __getitem__(self, name: str) -> ProductView:
+        return ProductView(self, self.rows[name])
+
+    def __contains__(self, name) -> bool:
+        return name in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class SortedIndex:
+    """
+    Индекс ключ -> имена товаров с упорядоченным списком различных ключей.
+    Изменение стоит O(1) плюс O(log k) на поиск ключа (k - число различных ключей),
+    выборка ключей меньше границы - O(log k + размер результата).
+    """
+
+    def __init__(self):
+        self.keys: List[Any] = []
+        # Ключ -> имена; dict вместо set, чтобы сохранять порядок добавления
+        self.buckets: Dict[Any, Dict[str, None]] = {}
+
+    def add(self, key, name: str):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {}
+            insort(self.keys, key)
+        bucket[name] = None
+
+    def remove(self, key, name: str):
+        bucket = self.buckets[key]
+        del bucket[name]
+        if not bucket:
+            del self.buckets[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    @classmethod
+    def from_groups(cls, keys: Sequence, counts: Sequence[int], names: Sequence[str]) -> "SortedIndex":
+        """
+        Собирает индекс из уже сгруппированных данных
+        :param keys: различные ключи по возрастанию
+        :param counts: сколько имён у каждого ключа
+        :param names: имена подряд по ключам, внутри ключа - в порядке добавления
+        """
+        index = cls()
+        index.keys = list(keys)
+        start = 0
+        for key, count in zip(index.keys, counts):
+            index.buckets[key] = dict.fromkeys(names[start:start + count])
+            start += count
+        return index
+
+    def below(self, bound, inclusive: bool = False) -> Iterator[str]:
+        """
+        :returns: имена с ключом < bound (<= bound при inclusive) по возрастанию ключа
+        """
+        end = bisect_right(self.keys, bound) if inclusive else bisect_left(self.keys, bound)
+        for i in range(end):
+            yield from self.buckets[self.keys[i]]
+
+
+def _search_key(name: str) -> str:
+    """
+    Ключ поиска без учёта регистра, ё = е
+    """
+    return name.casefold().replace('ё', 'е').replace('\0', '')
+
+
+class NameIndex:
+    """
+    Поиск товаров по началу имени без учёта регистра, в том числе с опечатками.
+    Ключи _search_key(name) + '\0' + name хранятся упорядоченным списком: начало имени - отрезок списка
+    (O(log n) на поиск), а сам список - неявное префиксное дерево для нечёткого поиска.
+    Новые имена копятся в pending и сортируются в список при следующем поиске,
+    так что загрузка всего склада стоит одну сортировку, а не вставку на каждое имя.
+    """
+    # До стольких новых имён вставляются по одному: сдвиг списка дешевле проверки порядка всех ключей
+    INSORT_LIMIT = 256
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.keys: List[str] = []
+        self.pending: List[str] = list(names)
+
+    def add(self, name: str):
+        self.pending.append(name)
+
+    def _flush(self):
+        if len(self.pending) <= self.INSORT_LIMIT:
+            for name in self.pending:
+                insort(self.keys, _search_key(name) + '\0' + name)
+        else:
+            self.keys.extend(_search_key(name) + '\0' + name for name in self.pending)
+            # Список уже упорядочен, кроме хвоста: сортировка сольёт их за O(n)
+            self.keys.sort()
+        self.pending = []
+
+    def _prefix_range(self, prefix: str) -> Tuple[int, int]:
+        keys = self.keys
+        if not prefix:
+            return 0, len(keys)
+        start = bisect_left(keys, prefix)
+        return start, bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+
+    def _children(self, start: int, stop: int, prefix: str, chars: Optional[Iterable[str]]
+                  ) -> Iterator[Tuple[str, int, int]]:
+        """
+        :param chars: какие следующие буквы искать; None - все
+        :returns: (буква, начало, конец) отрезков ключей с началом prefix + буква по возрастанию
+        """
+        keys = self.keys
+        depth = len(prefix)
+        if chars is None:
+            i = start
+            while i < stop:
+                c = keys[i][depth]
+                end = bisect_left(keys, prefix + chr(ord(c) + 1), i, stop)
+                # '\0' - имя кончилось на prefix
+                if c != '\0':
+                    yield c, i, end
+                i = end
+        else:
+            for c in chars:
+                i = bisect_left(keys, prefix + c, start, stop)
+                end = bisect_left(keys, prefix + chr(ord(c) + 1), i, stop)
+                if i < end:
+                    yield c, i, end
+
+    def _fuzzy_ranges(self, query: str, distance: int) -> Iterator[Tuple[int, int]]:
+        """
+        Отрезки ключей, у которых какое-то начало имени отличается от query не больше чем на distance
+        правок (расстояние Левенштейна), по возрастанию. Обход неявного дерева строкой динамики
+        по query; когда запаса правок нет, продолжают строку только совпадающие с query буквы,
+        и перебираются только они.
+        """
+        row = list(range(len(query) + 1))
+        if row[-1] <= distance:
+            yield 0, len(self.keys)
+            return
+        # (начало, конец, префикс, строка динамики); строка None - отрезок найден
+        stack = [(0, len(self.keys), '', row)]
+        while stack:
+            start, stop, prefix, row = stack.pop()
+            if row is None:
+                yield start, stop
+                continue
+            chars = None
+            if min(row) == distance:
+                chars = sorted({query[j] for j in range(len(query)) if row[j] == distance})
+            found = []
+            for c, child_start, child_stop in self._children(start, stop, prefix, chars):
+                child = [row[0] + 1]
+                for j, q in enumerate(query):
+                    child.append(min(row[j + 1] + 1, child[j] + 1, row[j] + (q != c)))
+                if child[-1] <= distance:
+                    found.append((child_start, child_stop, None, None))
+                elif min(child) <= distance:
+                    found.append((child_start, child_stop, prefix + c, child))
+            stack.extend(reversed(found))
+
+    def search(self, query: str, limit: int = 10, max_distance: int = 2,
+               accept: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """
+        Имена, начинающиеся с query с точностью до max_distance правок.
+        Сначала точные совпадения начала, затем с одной правкой и т.д., внутри - по алфавиту;
+        следующее расстояние ищется, только если не набрано limit имён.
+        :param accept: фильтр имён
+        """
+        self._flush()
+        query = _search_key(query)
+        keys = self.keys
+        found: Dict[str, None] = {}
+        for distance in range(max_distance + 1):
+            ranges = [self._prefix_range(query)] if distance == 0 else self._fuzzy_ranges(query, distance)
+            for start, stop in ranges:
+                for i in range(start, stop):
+                    name = keys[i].partition('\0')[2]
+                    if name not in found and (accept is None or accept(name)):
+                        found[name] = None
+                        if len(found) == limit:
+                            return list(found)
+        return list(found)
+
+
+class Reservation:
+    """
+    Товары, зарезервированные под заказ: списаны со склада до commit или возвращаются release.
+    """
+
+    def __init__(self, items: Dict[str, int]):
+        self.items = items
+        # active -> committed | released
+        self.state = "active"
+
+
+class CachedClock:
+    """
+    Часы для Storage, которые обращаются к source не чаще раза в resolution секунд.
+    Между обращениями возвращают прежний момент, поэтому могут отставать на resolution.
+    """
+
+    def __init__(self, resolution: float = 1.0, source: Callable[[], datetime] = datetime.now):
+        self.resolution = resolution
+        self.source = source
+        self._now = source()
+        self._refresh_at = monotonic() + resolution
+
+    def __call__(self) -> datetime:
+        if monotonic() >= self._refresh_at:
+            self._now = self.source()
+            self._refresh_at = monotonic() + self.resolution
+        return self._now
+
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+class ExpiryScheduler:
+    """
+    Множества испорченных товаров и тех, что испортятся быстрее чем через horizon.
+    Корзины - дни индекса срока годности; advance(now) переносит в множества только корзины,
+    чей срок наступил с прошлого вызова, а до следующей полуночи или границы horizon не делает ничего.
+    Так проверка срока при продаже сводится к поиску в множестве.
+    """
+
+    def __init__(self, index: SortedIndex, horizon: timedelta = timedelta(hours=24)):
+        self.index = index
+        self.horizon = horizon
+        self.expired = set()
+        # Включая уже испорченные, как products_expiring_within
+        self.expiring = set()
+        self._reset()
+
+    def _reset(self):
+        self.expired.clear()
+        self.expiring.clear()
+        self._now = datetime.min
+        # Даты меньше границы уже перенесены в множество
+        self._expired_bound = self._expiring_bound = date.min
+        # Моменты, когда границы сдвинутся
+        self._expired_at = self._expiring_at = datetime.min
+
+    def _move(self, names: set, start: date, stop: date):
+        keys = self.index.keys
+        for key in keys[bisect_left(keys, start):bisect_left(keys, stop)]:
+            names.update(self.index.buckets[key])
+
+    def advance(self, now: datetime):
+        if now < self._now:
+            # Часы пошли назад (например, подменены в тесте): пересчитываем с начала
+            self._reset()
+        elif now < self._expired_at and now <= self._expiring_at:
+            return
+        self._now = now
+        # Испорчен, если полночь даты окончания срока уже наступила: d <= now.date()
+        expired_bound = now.date() + timedelta(days=1)
+        # Испортится раньше deadline, если полночь d < deadline
+        deadline = now + self.horizon
+        expiring_bound = deadline.date()
+        if deadline.time() != datetime.min.time():
+            expiring_bound += timedelta(days=1)
+        self._move(self.expired, self._expired_bound, expired_bound)
+        self._move(self.expiring, self._expiring_bound, expiring_bound)
+        self._expired_bound, self._expiring_bound = expired_bound, expiring_bound
+        self._expired_at = _midnight(expired_bound)
+        self._expiring_at = _midnight(expiring_bound) - self.horizon
+
+    def add(self, name: str, expiration: date):
+        """
+        Учитывает товар, добавленный в индекс после advance
+        """
+        if expiration < self._expired_bound:
+            self.expired.add(name)
+        if expiration < self._expiring_bound:
+            self.expiring.add(name)
+
+
 class Storage:
     """
     Управление складом.
+    Количество и срок годности товаров индексируются, поэтому отчёты о закупке и утилизации
+    стоят пропорционально размеру результата. Количество нужно менять через add_product
+    и change_quantity, иначе индекс разойдётся с товарами.
+    При columnar=True товары хранятся в компактном Catalog, а не отдельными объектами.
+    Цены меняются через set_price, чтобы корзины с товаром обновили свои суммы.
+    Сроки годности сверяются с clock (например, CachedClock), по умолчанию datetime.now.
     """
 
-    def __init__(self):
-        self.products: Dict[str, CombinedProduct] = {}
+    def __init__(self, columnar: bool = False, clock: Callable[[], datetime] = datetime.now):
+        self.products: Union[Dict[str, CombinedProduct], Catalog] = Catalog() if columnar else {}
+        self.clock = clock
+        # Товар -> корзины, в которых он лежит
+        self._carts: Dict[str, WeakSet] = {}
+        self._by_quantity = SortedIndex()
+        self._by_expiration = SortedIndex()
+        self._expiry = ExpiryScheduler(self._by_expiration)
+        self._names = NameIndex()
+        # В ConcurrentStorage - блокировка общих индексов, здесь ничего не блокирует
+        self._index_lock = nullcontext()
+
+    def _lock(self, names: Iterable[str]):
+        """
+        :returns: контекст, в котором остатки товаров names не меняются другими потоками
+        """
+        return nullcontext()
 
     def add_product(self, product: CombinedProduct):
-        if product.name in self.products:
-            # Обновляем количество
-            self.products[product.name].quantity += product.quantity
-        else:
-            # Добавляем новый продукт
-            self.products[product.name] = product
+        with self._lock((product.name,)):
+            if product.name in self.products:
+                # Обновляем количество
+                self.change_quantity(product.name, product.quantity)
+            else:
+                # Добавляем новый продукт
+                with self._index_lock:
+                    self.products[product.name] = product
+                    self._by_quantity.add(product.quantity, product.name)
+                    self._names.add(product.name)
+                    if product.is_perishable():
+                        self._add_expiration(product.name, product.perishable.expiration_date())
+
+    def add_rows(self, rows: Iterable[Tuple[str, tuple]]) -> int:
+        """
+        Добавляет товары, заданные значениями строк Catalog (см. catalog_row), как add_product
+        :returns: сколько товаров были новыми
+        """
+        added = 0
+        for name, values in rows:
+            with self._lock((name,)):
+                if name in self.products:
+                    self.change_quantity(name, values[1])
+                else:
+                    self._add_row(name, values)
+                    added += 1
+        return added
+
+    def _add_row(self, name: str, values: Sequence):
+        # Колоночный склад принимает строку как есть, без промежуточных объектов товара
+        with self._index_lock:
+            if isinstance(self.products, Catalog):
+                self.products.append_row(name, values)
+            else:
+                self.products[name] = Catalog._row_product(name, values)
+            self._by_quantity.add(values[1], name)
+            self._names.add(name)
+            if values[8] & Catalog.PERISHABLE:
+                self._add_expiration(name, date.fromordinal(values[6] + values[7]))
+
+    def _add_expiration(self, name: str, expiration: date):
+        self._by_expiration.add(expiration, name)
+        self._expiry.add(name, expiration)
+
+    def change_quantity(self, name: str, delta: int):
+        """
+        Изменяет остаток товара на delta с обновлением индекса
+        """
+        with self._lock((name,)):
+            product = self.products[name]
+            # Остаток меняется вместе с индексом: save_snapshot под _index_lock видит их согласованными
+            with self._index_lock:
+                old_quantity = product.quantity
+                product.quantity += delta
+                self._by_quantity.remove(old_quantity, name)
+                self._by_quantity.add(product.quantity, name)
+
+    def take(self, name: str, quantity: int) -> bool:
+        """
+        Атомарно списывает quantity товара, если его хватает на складе
+        :returns: True если товар списан
+        """
+        with self._lock((name,)):
+            if self.products[name].quantity < quantity:
+                return False
+            self.change_quantity(name, -quantity)
+            return True
 
-    def get_product(self, name: str) -> Optional[CombinedProduct]:
-        return self.products.get(name)
+    def reserve(self, items: Dict[str, int]) -> Tuple[Optional[Reservation], List[str]]:
+        """
+        Атомарно резервирует сразу все товары заказа: либо списываются все, либо ни один.
+        :param items: имя товара -> количество
+        :returns: Резерв (None при отказе) и список причин отказа.
+        """
+        warnings = []
+        with self._lock(items):
+            for name, quantity in items.items():
+                product = self.products.get(name)
+                if product is None:
+                    warnings.append(f"Товар '{name}' отсутствует на складе.")
+                elif quantity > product.quantity:
+                    warnings.append(
+                        f"Товара '{name}' на складе недостаточно (запрошено {quantity}, есть {product.quantity}).")
+            if warnings:
+                return None, warnings
+            for name, quantity in items.items():
+                self.change_quantity(name, -quantity)
+        return Reservation(dict(items)), warnings
+
+    def commit(self, reservation: Reservation):
+        """
+        Подтверждает резерв: товары окончательно проданы
+        """
+        with self._lock(reservation.items):
+            if reservation.state != "active":
+                raise ValueError(f"Резерв уже {reservation.state}")
+            reservation.state = "committed"
 
+    def release(self, reservation: Reservation):
+        """
+        Отменяет резерв и возвращает товары на склад
+        """
+        with self._lock(reservation.items):
+            if reservation.state != "active":
+                raise ValueError(f"Резерв уже {reservation.state}")
+            for name, quantity in reservation.items.items():
+                self.change_quantity(name, quantity)
+            reservation.state = "released"
+
+    def set_price(self, name: str, price: float):
+        """
+        Меняет цену товара и пересчитывает стоимость корзин, в которых он лежит
+        """
+        with self._lock((name,)):
+            product = self.products[name]
+            old_price = product.price
+            product.price = price
+            for cart in list(self._carts.get(name, ())):
+                cart.on_price_change(name, old_price, price)
+
+    def watch(self, name: str, cart: "Cart"):
+        """
+        Подписывает корзину на изменения цены товара
+        """
+        with self._lock((name,)):
+            self._carts.setdefault(name, WeakSet()).add(cart)
+
+    def unwatch(self, name: str, cart: "Cart"):
+        with self._lock((name,)):
+            carts = self._carts.get(name)
+            if carts is not None:
+                carts.discard(cart)
+                if not carts:
+                    del self._carts[name]
+
+    def save_snapshot(self, path: str, wal_generation: int = 0):
+        """
+        Атомарно записывает снимок склада: колонки Catalog и индексы одним бинарным файлом.
+        Файл пишется рядом и подменяется через os.replace, так что при сбое остаётся прежний снимок.
+        :param wal_generation: поколение журнала, все записи которого уже вошли в снимок
+        """
+        with self._index_lock:
+            catalog = self.products
+            if not isinstance(catalog, Catalog):
+                catalog = Catalog()
+                for name, product in self.products.items():
+                    catalog[name] = product
+            names = '\0'.join(catalog.names).encode('utf-8')
+            if len(catalog.names) != names.count(b'\0') + bool(catalog.names):
+                raise ValueError("Имя товара не может содержать символ \\0")
+            sections = [names] + [getattr(catalog, column).tobytes() for column in Catalog.COLUMNS]
+            for index, key_code in ((self._by_quantity, int), (self._by_expiration, date.toordinal)):
+                rows = array('q', (catalog.rows[name] for key in index.keys for name in index.buckets[key]))
+                sections.append(array('q', map(key_code, index.keys)).tobytes())
+                sections.append(array('q', (len(index.buckets[key]) for key in index.keys)).tobytes())
+                sections.append(rows.tobytes())
+
+        header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _snapshot_layout(), wal_generation, len(catalog.names),
+                                       *map(len, sections))
+        checksum = zlib.crc32(header)
+        for section in sections:
+            checksum = zlib.crc32(section, checksum)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(header)
+            for section in sections:
+                file.write(section)
+                file.write(b'\0' * (-len(section) % 8))
+            file.write(struct.pack('<I', checksum))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        _fsync_directory(path)
+
+    def load_snapshot(self, path: str) -> int:
+        """
+        Заменяет содержимое пустого склада снимком save_snapshot. Склад становится колоночным,
+        колонки копируются из отображённого в память файла без разбора по товарам.
+        :returns: поколение журнала, записанное в снимке
+        :raises ValueError: если файл повреждён или записан на платформе с другими размерами типов
+        """
+        if self.products:
+            raise ValueError("Снимок загружается только в пустой склад")
+        sections: List[memoryview] = []
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer, \
+                memoryview(buffer) as view:
+            try:
+                wal_generation, count = _snapshot_sections(view, sections)
+                self._load_sections(count, sections)
+            finally:
+                # mmap не закрывается, пока на него есть срезы
+                for section in sections:
+                    section.release()
+        return wal_generation
+
+    def _load_sections(self, count: int, sections: List[memoryview]):
+        catalog = Catalog()
+        catalog.names = bytes(sections[0]).decode('utf-8').split('\0') if count else []
+        catalog.rows = dict(zip(catalog.names, range(count)))
+        for column, section in zip(Catalog.COLUMNS, sections[1:]):
+            getattr(catalog, column).frombytes(section)
+        indexes = []
+        for key_code, start in ((int, 10), (date.fromordinal, 13)):
+            keys, counts, rows = (_int64_array(section) for section in sections[start:start + 3])
+            # itemgetter выбирает имена строк без цикла на Python
+            names = list(itemgetter(*rows)(catalog.names)) if len(rows) > 1 else [catalog.names[r] for r in rows]
+            indexes.append(SortedIndex.from_groups(list(map(key_code, keys)), counts, names))
+        with self._index_lock:
+            self.products = catalog
+            self._by_quantity, self._by_expiration = indexes
+            self._expiry = ExpiryScheduler(self._by_expiration)
+            # Имена сортируются при первом поиске, а не при загрузке
+            self._names = NameIndex(catalog.names)
+
+    def get_product(self, name: str) -> Optional[CombinedProduct]:
+        if not METRICS.enabled:
+            return self.products.get(name)
+        # Без декоратора: самый частый запрос, лишний вызов заметен
+        start = perf_counter_ns()
+        try:
+            return self.products.get(name)
+        finally:
+            METRICS.finish_span('storage.get_product', start, STORAGE_QUERY_SECONDS)
+
+    @METRICS.traced('storage.list_products', STORAGE_QUERY_SECONDS)
     def list_products(self) -> List[CombinedProduct]:
-        return list(self.products.values())
+        with self._index_lock:
+            return list(self.products.values())
 
+    @METRICS.traced('storage.search', STORAGE_QUERY_SECONDS)
+    def search(self, query: str, limit: int = 10, max_distance: int = 2,
+               food: Optional[bool] = None, perishable: Optional[bool] = None,
+               vitamins: Optional[bool] = None) -> List[CombinedProduct]:
+        """
+        Товары, имя которых начинается с query без учёта регистра, с опечатками до max_distance правок.
+        Точные совпадения идут первыми (см. NameIndex.search).
+        :param food: True - только еда, False - только не еда, None - любые; так же perishable и vitamins
+        """
+        wanted = [(check, flag) for check, flag in (('is_food', food), ('is_perishable', perishable),
+                                                    ('is_vitamins', vitamins)) if flag is not None]
+        with self._index_lock:
+            products = self.products
+
+            def accept(name: str) -> bool:
+                product = products[name]
+                return all(getattr(product, check)() == flag for check, flag in wanted)
+
+            names = self._names.search(query, limit, max_distance, accept if wanted else None)
+            return [products[name] for name in names]
+
+    @METRICS.traced('storage.products_to_restock', STORAGE_QUERY_SECONDS)
     def products_to_restock(self, threshold: int = 5) -> List[CombinedProduct]:
-        return [p for p in self.products.values() if p.quantity < threshold]
+        with self._index_lock:
+            return [self.products[name] for name in self._by_quantity.below(threshold)]
 
+    @METRICS.traced('storage.is_expiring', STORAGE_QUERY_SECONDS)
+    def is_expiring(self, name: str) -> bool:
+        """
+        :returns: True если товар испортится меньше чем через 24 часа или уже испорчен
+        """
+        with self._index_lock:
+            self._expiry.advance(self.clock())
+            return name in self._expiry.expiring
+
+    @METRICS.traced('storage.products_to_dispose', STORAGE_QUERY_SECONDS)
     def products_to_dispose(self) -> List[CombinedProduct]:
-        to_dispose = []
-        for p in self.products.values():
-            if p.is_perishable():
-                if p.perishable.is_expired():
-                    to_dispose.append(p)
-        return to_dispose
+        # Истёк, если полночь даты окончания срока уже наступила
+        today = self.clock().date()
+        with self._index_lock:
+            return [self.products[name] for name in self._by_expiration.below(today, inclusive=True)]
+
+    @METRICS.traced('storage.products_expiring_within', STORAGE_QUERY_SECONDS)
+    def products_expiring_within(self, delta: timedelta) -> List[CombinedProduct]:
+        """
+        :returns: товары, до конца срока годности которых меньше delta (включая уже испорченные)
+        """
+        deadline = self.clock() + delta
+        # Полночь даты d раньше deadline, если d < deadline.date() или d == deadline.date() и сейчас не полночь
+        inclusive = deadline.time() != datetime.min.time()
+        with self._index_lock:
+            return [self.products[name] for name in self._by_expiration.below(deadline.date(), inclusive)]
+
+
+class _StripeLocks:
+    """
+    Захватывает несколько блокировок по возрастанию номера и отпускает в обратном порядке.
+    """
+
+    def __init__(self, locks: List[RLock]):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, *exc):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
+class ConcurrentStorage(Storage):
+    """
+    Потокобезопасный склад без общей блокировки на запрос.
+    Остатки защищены полосами блокировок: товар попадает в одну из stripes полос по хэшу имени,
+    заказ из нескольких товаров берёт их полосы по возрастанию номера, поэтому взаимоблокировок нет.
+    Общие индексы защищены отдельной блокировкой, которая держится только на время их изменения.
+    """
+
+    def __init__(self, columnar: bool = False, stripes: int = 64, clock: Callable[[], datetime] = datetime.now):
+        super().__init__(columnar, clock)
+        self._stripes = [RLock() for _ in range(stripes)]
+        self._index_lock = Lock()
+
+    def _lock(self, names: Iterable[str]) -> _StripeLocks:
+        stripes = sorted({hash(name) % len(self._stripes) for name in names})
+        return _StripeLocks([self._stripes[i] for i in stripes])
+
+
+_SNAPSHOT_MAGIC = b'STSNAP01'
+# magic, раскладка типов, поколение журнала, число товаров, длины 16 секций:
+# имена, 9 колонок, по 3 на индексы количества и срока годности (ключи, размеры групп, строки)
+_SNAPSHOT_HEADER = struct.Struct('<8s32sQQ16Q')
+
+
+def _snapshot_layout() -> bytes:
+    """
+    Типы и размеры колонок: снимок читается только там, где array даёт те же размеры
+    """
+    catalog = Catalog()
+    return ''.join(f"{getattr(catalog, column).typecode}{getattr(catalog, column).itemsize}"
+                   for column in Catalog.COLUMNS).encode().ljust(32, b'\0')
+
+
+def _snapshot_sections(view: memoryview, sections: List[memoryview]) -> Tuple[int, int]:
+    """
+    Проверяет снимок и добавляет в sections срезы view с его секциями
+    :returns: поколение журнала и число товаров
+    """
+    if len(view) < _SNAPSHOT_HEADER.size + 4:
+        raise ValueError("Снимок обрезан")
+    magic, layout, wal_generation, count, *lengths = _SNAPSHOT_HEADER.unpack_from(view)
+    if magic != _SNAPSHOT_MAGIC or layout != _snapshot_layout():
+        raise ValueError("Неизвестный формат снимка")
+    offset = _SNAPSHOT_HEADER.size
+    checksum = zlib.crc32(view.obj[:offset])
+    for length in lengths:
+        if offset + length + 4 > len(view):
+            raise ValueError("Снимок обрезан")
+        sections.append(view[offset:offset + length])
+        checksum = zlib.crc32(sections[-1], checksum)
+        offset += length + (-length % 8)
+    if struct.unpack_from('<I', view, offset)[0] != checksum:
+        raise ValueError("Контрольная сумма снимка не совпадает")
+    return wal_generation, count
+
+
+def _int64_array(buffer) -> array:
+    values = array('q')
+    values.frombytes(buffer)
+    return values
+
+
+def _fsync_directory(path: str):
+    # Без этого переименование файла может не пережить отключение питания
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+_WAL_MAGIC = b'STWAL001'
+_WAL_HEADER = struct.Struct('<8sQ')
+# Длина и crc32 тела записи
+_WAL_RECORD = struct.Struct('<II')
+_WAL_ROW = struct.Struct('<dqddddllB')
+_WAL_DELTA = struct.Struct('<q')
+_WAL_PRICE = struct.Struct('<d')
+
+
+class WriteAheadLog:
+    """
+    Журнал изменений склада: добавление товара, изменение остатка и цены.
+    Каждая запись - длина, crc32 и тело; запись, оборванная сбоем, отбрасывается при чтении.
+    Поколение в заголовке связывает журнал со снимком, в который вошли его записи.
+    """
+    ADD = b'A'
+    QUANTITY = b'Q'
+    PRICE = b'P'
+
+    def __init__(self, path: str, fsync: bool = False):
+        """
+        :param fsync: сбрасывать каждую запись на диск; без него запись переживёт падение процесса,
+        но не отключение питания
+        """
+        self.path = path
+        self.fsync = fsync
+        self.file = None
+        # Размер целой части журнала по последнему read()
+        self._valid_size = 0
+
+    def read(self) -> Tuple[int, List[tuple]]:
+        """
+        :returns: поколение журнала и его целые записи (операция, имя, значение)
+        """
+        self._valid_size = 0
+        if not os.path.exists(self.path):
+            return 0, []
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        if len(data) < _WAL_HEADER.size:
+            return 0, []
+        magic, generation = _WAL_HEADER.unpack_from(data)
+        if magic != _WAL_MAGIC:
+            raise ValueError("Неизвестный формат журнала")
+        records = []
+        offset = _WAL_HEADER.size
+        while offset + _WAL_RECORD.size <= len(data):
+            length, checksum = _WAL_RECORD.unpack_from(data, offset)
+            body = data[offset + _WAL_RECORD.size:offset + _WAL_RECORD.size + length]
+            if len(body) < length or zlib.crc32(body) != checksum:
+                break
+            records.append(self._decode(body))
+            offset += _WAL_RECORD.size + length
+        self._valid_size = offset
+        return generation, records
+
+    @staticmethod
+    def _decode(body: bytes) -> tuple:
+        op = body[:1]
+        name_length = body[1] | body[2] << 8
+        name = body[3:3 + name_length].decode('utf-8')
+        rest = body[3 + name_length:]
+        if op == WriteAheadLog.ADD:
+            return op, name, _WAL_ROW.unpack(rest)
+        if op == WriteAheadLog.QUANTITY:
+            return op, name, _WAL_DELTA.unpack(rest)[0]
+        return op, name, _WAL_PRICE.unpack(rest)[0]
+
+    def open(self, generation: int):
+        """
+        Открывает журнал на дозапись, обрезая оборванный хвост.
+        Если поколение файла другое, начинает новый журнал этого поколения.
+        """
+        file_generation, _ = self.read()
+        if file_generation == generation and self._valid_size:
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(self._valid_size)
+            self.file.seek(self._valid_size)
+        else:
+            self.reset(generation)
+
+    def reset(self, generation: int):
+        """
+        Атомарно заменяет журнал пустым журналом поколения generation
+        """
+        if self.file is not None:
+            self.file.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(_WAL_HEADER.pack(_WAL_MAGIC, generation))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        _fsync_directory(self.path)
+        self.file = open(self.path, 'r+b')
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, op: bytes, name: str, payload: bytes):
+        encoded = name.encode('utf-8')
+        body = op + struct.pack('<H', len(encoded)) + encoded + payload
+        self.file.write(_WAL_RECORD.pack(len(body), zlib.crc32(body)) + body)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class DurableStorage(Storage):
+    """
+    Склад, переживающий перезапуск: снимок snapshot.bin и журнал wal.bin в каталоге directory.
+    При открытии загружается снимок и проигрываются записи журнала после него.
+    Все изменения (add_product, change_quantity - в том числе из корзин и резервов, set_price)
+    дописываются в журнал; checkpoint() пишет новый снимок и начинает пустой журнал.
+    Товары хранятся колоночно.
+    """
+
+    def __init__(self, directory: str, fsync: bool = False):
+        super().__init__(columnar=True)
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self._wal = None
+        self.generation = 0
+        if os.path.exists(self.snapshot_path):
+            self.generation = self.load_snapshot(self.snapshot_path)
+        wal = WriteAheadLog(os.path.join(directory, 'wal.bin'), fsync)
+        wal_generation, records = wal.read()
+        # Журнал старшего поколения ещё не вошёл в снимок; журнал того же поколения - снимок упал до смены журнала
+        if wal_generation > self.generation:
+            self.generation = wal_generation
+            for op, name, value in records:
+                if op == WriteAheadLog.ADD:
+                    self._add_row(name, value)
+                elif op == WriteAheadLog.QUANTITY:
+                    self.change_quantity(name, value)
+                else:
+                    self.set_price(name, value)
+            wal.open(self.generation)
+        else:
+            self.generation += 1
+            wal.reset(self.generation)
+        self._wal = wal
+
+    def add_product(self, product: CombinedProduct):
+        with self._lock((product.name,)):
+            is_new = product.name not in self.products
+            super().add_product(product)
+            # Пополнение существующего товара журналирует change_quantity
+            if is_new and self._wal is not None:
+                self._wal.append(WriteAheadLog.ADD, product.name, _WAL_ROW.pack(*Catalog._row_values(product)))
+
+    def _add_row(self, name: str, values: Sequence):
+        super()._add_row(name, values)
+        if self._wal is not None:
+            self._wal.append(WriteAheadLog.ADD, name, _WAL_ROW.pack(*values))
+
+    def change_quantity(self, name: str, delta: int):
+        with self._lock((name,)):
+            super().change_quantity(name, delta)
+            if self._wal is not None:
+                self._wal.append(WriteAheadLog.QUANTITY, name, _WAL_DELTA.pack(delta))
+
+    def set_price(self, name: str, price: float):
+        with self._lock((name,)):
+            super().set_price(name, price)
+            if self._wal is not None:
+                self._wal.append(WriteAheadLog.PRICE, name, _WAL_PRICE.pack(price))
+
+    def checkpoint(self):
+        """
+        Записывает снимок и начинает пустой журнал следующего поколения.
+        Сбой между этими шагами безопасен: журнал с поколением снимка при открытии пропускается.
+        """
+        self.save_snapshot(self.snapshot_path, self.generation)
+        self.generation += 1
+        self._wal.reset(self.generation)
+
+    def close(self):
+        self._wal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class Cart:
     """
     Корзина пользователя.
+    Стоимость и БЖУ поддерживаются нарастающим итогом, поэтому total_cost, total_bju_calories
+    и check_norms стоят O(1). Содержимое меняется только через add_item, remove_item и clear.
     """
 
     def __init__(self, storage: Storage):
         self.storage = storage
         # Словарь: имя товара -> количество
         self.items: Dict[str, int] = {}
+        # Нарастающие итоги: стоимость, белки, жиры, углеводы, калории
+        self._cost = 0.0
+        self._bju = [0.0, 0.0, 0.0, 0.0]
         # Пользовательские нормы БЖУ и калорий
         self.norm_proteins = None
         self.norm_fats = None
@@ -179,11 +1249,15 @@ class Cart:
         product = self.storage.get_product(product_name)
         if product is None:
             warnings.append(f"Товар '{product_name}' отсутствует на складе.")
+            if METRICS.enabled:
+                CART_REJECTIONS.inc('missing')
             return warnings
 
         if quantity > product.quantity:
             warnings.append(
                 f"Товара '{product_name}' на складе недостаточно (запрошено {quantity}, есть {product.quantity}).")
+            if METRICS.enabled:
+                CART_REJECTIONS.inc('stock')
 
         """
         Проверка витаминов
@@ -195,29 +1269,79 @@ class Cart:
         """
         if product.is_vitamins() and not (product.vitamins.without_prescription or has_prescription):
             warnings.append(f"Витамины '{product_name}' нельзя отпускать без рецепта.")
+            if METRICS.enabled:
+                CART_REJECTIONS.inc('prescription')
 
         # Проверяем срок годности, до конца >= 24 часа
         if product.is_perishable():
-            if product.perishable.expires_in_less_than(timedelta(hours=24)):
+            if self.storage.is_expiring(product_name):
                 warnings.append(f"Товар '{product_name}' испортится менее чем через 24 часа и не может быть продан.")
+                if METRICS.enabled:
+                    CART_REJECTIONS.inc('expiry')
 
         # Если предупреждений нет, добавляем в корзину
         if not warnings:
+            # Проверка и списание атомарны: между ними товар мог купить другой поток
+            if not self.storage.take(product_name, quantity):
+                warnings.append(
+                    f"Товара '{product_name}' на складе недостаточно (запрошено {quantity}, есть {product.quantity}).")
+                if METRICS.enabled:
+                    CART_REJECTIONS.inc('stock')
+                return warnings
+            if product_name not in self.items:
+                self.storage.watch(product_name, self)
             self.items[product_name] = self.items.get(product_name, 0) + quantity
-            self.storage.products[product_name].quantity -= quantity
+            self._add_to_totals(product, quantity)
 
         return warnings
 
+    def remove_item(self, product_name: str, quantity: Optional[int] = None):
+        """
+        Убирает товар из корзины и возвращает его на склад.
+        :param quantity: Сколько убрать, по умолчанию всё.
+        """
+        in_cart = self.items.get(product_name, 0)
+        if quantity is None or quantity > in_cart:
+            quantity = in_cart
+        if quantity <= 0:
+            return
+
+        if quantity == in_cart:
+            del self.items[product_name]
+            self.storage.unwatch(product_name, self)
+        else:
+            self.items[product_name] = in_cart - quantity
+        self.storage.change_quantity(product_name, quantity)
+        if self.items:
+            self._add_to_totals(self.storage.get_product(product_name), -quantity)
+        else:
+            # Пустая корзина: сбрасываем накопленную погрешность округления
+            self._reset_totals()
+
+    def _add_to_totals(self, product: CombinedProduct, quantity: int):
+        self._cost += product.price * quantity
+        if product.is_food():
+            food = product.food
+            self._bju[0] += food.proteins * quantity
+            self._bju[1] += food.fats * quantity
+            self._bju[2] += food.carbs * quantity
+            self._bju[3] += food.calories * quantity
+
+    def _reset_totals(self):
+        self._cost = 0.0
+        self._bju = [0.0, 0.0, 0.0, 0.0]
+
+    def on_price_change(self, product_name: str, old_price: float, new_price: float):
+        """
+        Вызывается складом при изменении цены товара из корзины
+        """
+        self._cost += (new_price - old_price) * self.items.get(product_name, 0)
+
     def total_cost(self) -> float:
         """
         :returns: Стоимость товаров в корзине
         """
-        cost = 0.0
-        for name, qty in self.items.items():
-            product = self.storage.get_product(name)
-            if product:
-                cost += product.price * qty
-        return cost
+        return self._cost
 
     def total_bju_calories(self):
         """
@@ -225,41 +1349,410 @@ class Cart:
         Если товар не является food, считает 0.
         :returns: Кортеж (белки, жиры, углеводы, калории)
         """
-        proteins = fats = carbs = calories = 0.0
-        for name, qty in self.items.items():
-            product = self.storage.get_product(name)
-            if product and product.is_food():
-                proteins += product.food.proteins * qty
-                fats += product.food.fats * qty
-                carbs += product.food.carbs * qty
-                calories += product.food.calories * qty
-        return proteins, fats, carbs, calories
+        return tuple(self._bju)
 
     def check_norms(self) -> List[str]:
         """
         Проверяет превышение норм БЖУ и калорий.
         :returns: Список предупреждений.
         """
-        warnings = []
-        if None in (self.norm_proteins, self.norm_fats, self.norm_carbs, self.norm_calories):
+        norms = (self.norm_proteins, self.norm_fats, self.norm_carbs, self.norm_calories)
+        if None in norms:
             # Нормы не установлены
-            return warnings
+            return []
+        return norm_warnings(self.total_bju_calories(), norms)
 
-        proteins, fats, carbs, calories = self.total_bju_calories()
+    def clear(self):
+        for name in self.items:
+            self.storage.unwatch(name, self)
+        self.items.clear()
+        self._reset_totals()
 
-        if proteins > self.norm_proteins:
-            warnings.append(f"Превышен уровень белков: {proteins:.2f} > {self.norm_proteins:.2f}")
-        if fats > self.norm_fats:
-            warnings.append(f"Превышен уровень жиров: {fats:.2f} > {self.norm_fats:.2f}")
-        if carbs > self.norm_carbs:
-            warnings.append(f"Превышен уровень углеводов: {carbs:.2f} > {self.norm_carbs:.2f}")
-        if calories > self.norm_calories:
-            warnings.append(f"Превышен уровень калорий: {calories:.2f} > {self.norm_calories:.2f}")
 
-        return warnings
+NORM_NAMES = ("белков", "жиров", "углеводов", "калорий")
 
-    def clear(self):
-        self.items.clear()
+
+def norm_warnings(totals: Sequence[float], norms: Sequence[float]) -> List[str]:
+    """
+    :param totals: белки, жиры, углеводы, калории
+    :param norms: нормы в том же порядке
+    :returns: Список предупреждений о превышении норм.
+    """
+    warnings = []
+    for name, value, norm in zip(NORM_NAMES, totals, norms):
+        if value > norm:
+            warnings.append(f"Превышен уровень {name}: {value:.2f} > {norm:.2f}")
+    return warnings
+
+
+def evaluate_carts(carts: List[Cart]) -> Dict[str, Any]:
+    """
+    Пакетно считает стоимость, БЖУ и превышение норм для многих корзин одного склада.
+    Каждый товар склада ищется один раз на пакет, суммы считаются массивами numpy
+    (без numpy - циклом) в порядке позиций корзины, поэтому числа совпадают с методами Cart
+    (при повторных add_item одного товара - с точностью до округления нарастающего итога).
+    :returns: Словарь: cost, proteins, fats, carbs, calories - значения по корзинам;
+              exceeded - по корзине 4 флага превышения норм БЖУ и калорий;
+              warnings - по корзине список предупреждений как у Cart.check_norms.
+    """
+    if len({id(cart.storage) for cart in carts}) > 1:
+        raise ValueError("Все корзины должны относиться к одному складу")
+
+    # Товар -> номер строки в таблице значений пакета, строка 0 - отсутствующий товар
+    product_rows: Dict[str, int] = {}
+    values = [(0.0, 0.0, 0.0, 0.0, 0.0)]
+    cart_ids, rows, quantities = [], [], []
+    for cart_id, cart in enumerate(carts):
+        for name, qty in cart.items.items():
+            row = product_rows.get(name)
+            if row is None:
+                row = product_rows[name] = len(values)
+                product = cart.storage.get_product(name)
+                if product is None:
+                    row = product_rows[name] = 0
+                elif product.is_food():
+                    food = product.food
+                    values.append((product.price, food.proteins, food.fats, food.carbs, food.calories))
+                else:
+                    values.append((product.price, 0.0, 0.0, 0.0, 0.0))
+            cart_ids.append(cart_id)
+            rows.append(row)
+            quantities.append(qty)
+
+    if np is not None:
+        table = np.array(values, dtype=np.float64)
+        cart_ids = np.array(cart_ids, dtype=np.intp)
+        line_values = table[np.array(rows, dtype=np.intp)] * np.array(quantities, dtype=np.float64)[:, None]
+        # bincount складывает строки корзины по порядку, как цикл в Cart
+        totals = [np.bincount(cart_ids, weights=line_values[:, i], minlength=len(carts)) for i in range(5)]
+    else:
+        totals = [[0.0] * len(carts) for _ in range(5)]
+        for cart_id, row, qty in zip(cart_ids, rows, quantities):
+            for i, value in enumerate(values[row]):
+                totals[i][cart_id] += value * qty
+
+    exceeded, warnings = [], []
+    for cart_id, cart in enumerate(carts):
+        norms = (cart.norm_proteins, cart.norm_fats, cart.norm_carbs, cart.norm_calories)
+        bju = [totals[i][cart_id] for i in range(1, 5)]
+        if None in norms:
+            exceeded.append((False,) * 4)
+            warnings.append([])
+        else:
+            exceeded.append(tuple(bool(value > norm) for value, norm in zip(bju, norms)))
+            warnings.append(norm_warnings(bju, norms))
+
+    cost, proteins, fats, carbs, calories = totals
+    return {
+        "cost": cost,
+        "proteins": proteins,
+        "fats": fats,
+        "carbs": carbs,
+        "calories": calories,
+        "exceeded": np.array(exceeded, dtype=bool).reshape(len(carts), 4) if np is not None else exceeded,
+        "warnings": warnings,
+    }
+
+
+CATALOG_FIELDS = ('name', 'price', 'quantity', 'proteins', 'fats', 'carbs', 'calories',
+                  'creation_date', 'shelf_life_days', 'without_prescription')
+_NUTRITION_FIELDS = ('proteins', 'fats', 'carbs', 'calories')
+# Пределы колонки quantity (array('q')) и даты окончания срока годности
+_MAX_QUANTITY = 2 ** 63 - 1
+_MAX_ORDINAL = date.max.toordinal()
+_BOOLEANS = {'true': True, '1': True, 'yes': True, 'да': True,
+             'false': False, '0': False, 'no': False, 'нет': False}
+
+
+def _number(record: dict, field: str, kind: type):
+    value = record.get(field)
+    try:
+        number = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"поле {field}: ожидается число, получено {value!r}") from None
+    if not number >= 0:
+        raise ValueError(f"поле {field}: ожидается неотрицательное число, получено {value!r}")
+    if kind is int and number != value and not isinstance(value, str):
+        raise ValueError(f"поле {field}: ожидается целое число, получено {value!r}")
+    return number
+
+
+def _is_count(value, number: int) -> bool:
+    # int(5.5) молча отбрасывает дробную часть
+    return number >= 0 and (number == value or isinstance(value, str))
+
+
+def catalog_row(record: dict) -> Tuple[str, tuple]:
+    """
+    Проверяет запись фида и переводит её в значения строки Catalog.
+    Товар - еда, если заданы все поля БЖУ и калорий; скоропортящийся, если заданы
+    creation_date (ГГГГ-ММ-ДД) и shelf_life_days; витамины, если задан without_prescription.
+    :returns: имя товара и значения в порядке Catalog.COLUMNS
+    :raises ValueError: с описанием первой ошибки в записи
+    """
+    # Числа сначала переводятся без проверки каждого поля отдельно: это горячий путь загрузки,
+    # а _number вызывается только чтобы описать ошибку
+    get = record.get
+    name = get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("поле name: пустое имя товара")
+    try:
+        price = float(get('price'))
+        quantity = int(get('quantity'))
+        valid = price >= 0 and _is_count(get('quantity'), quantity)
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        price = _number(record, 'price', float)
+        quantity = _number(record, 'quantity', int)
+    if quantity > _MAX_QUANTITY:
+        raise ValueError(f"поле quantity: ожидается число не больше {_MAX_QUANTITY}, получено {get('quantity')!r}")
+    flags = 0
+    proteins = fats = carbs = calories = 0.0
+    creation_ordinal = shelf_life_days = 0
+
+    nutrition = [get(field) for field in _NUTRITION_FIELDS]
+    filled = [value is not None and value != '' for value in nutrition]
+    if any(filled):
+        if not all(filled):
+            missing = ', '.join(field for field, present in zip(_NUTRITION_FIELDS, filled) if not present)
+            raise ValueError(f"у продукта питания не заданы поля {missing}")
+        try:
+            proteins, fats, carbs, calories = map(float, nutrition)
+            valid = proteins >= 0 and fats >= 0 and carbs >= 0 and calories >= 0
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            proteins, fats, carbs, calories = (_number(record, field, float) for field in _NUTRITION_FIELDS)
+        flags |= Catalog.FOOD
+
+    creation_date = get('creation_date')
+    shelf_life = get('shelf_life_days')
+    if creation_date not in (None, '') or shelf_life not in (None, ''):
+        try:
+            creation_ordinal = date.fromisoformat(str(creation_date)).toordinal()
+        except ValueError:
+            raise ValueError(f"поле creation_date: ожидается дата ГГГГ-ММ-ДД, получено {creation_date!r}") from None
+        shelf_life_days = _number(record, 'shelf_life_days', int)
+        if creation_ordinal + shelf_life_days > _MAX_ORDINAL:
+            raise ValueError(f"поле shelf_life_days: срок годности заканчивается позже {date.max}, "
+                             f"получено {shelf_life!r}")
+        flags |= Catalog.PERISHABLE
+
+    value = get('without_prescription')
+    if value is not None and value != '':
+        without_prescription = value if isinstance(value, bool) else _BOOLEANS.get(str(value).strip().lower())
+        if without_prescription is None:
+            raise ValueError(f"поле without_prescription: ожидается да/нет, получено {value!r}")
+        flags |= Catalog.VITAMINS
+        if without_prescription:
+            flags |= Catalog.WITHOUT_PRESCRIPTION
+
+    return name, (price, quantity, proteins, fats, carbs, calories, creation_ordinal, shelf_life_days, flags)
+
+
+def parse_catalog_chunk(records: List, first_line: int, header: Optional[List[str]] = None
+                        ) -> Tuple[List[Tuple[str, tuple]], List[str]]:
+    """
+    Разбирает часть фида. Функция верхнего уровня, чтобы её можно было выполнять в пуле процессов.
+    :param records: строки JSONL или уже разобранные строки CSV (списки полей)
+    :param first_line: номер строки файла первой записи, для сообщений об ошибках
+    :param header: имена колонок CSV; None для JSONL
+    :returns: строки Catalog и ошибки вида "строка N: ..."
+    """
+    rows = []
+    errors = []
+    for line, record in enumerate(records, first_line):
+        try:
+            if header is None:
+                if not record.strip():
+                    # Пустые строки JSONL пропускаются, но учитываются в нумерации
+                    continue
+                record = json.loads(record)
+                if not isinstance(record, dict):
+                    raise ValueError("ожидается JSON-объект")
+            else:
+                if len(record) != len(header):
+                    raise ValueError(f"ожидается {len(header)} полей, получено {len(record)}")
+                record = dict(zip(header, record))
+            rows.append(catalog_row(record))
+        except ValueError as error:
+            errors.append(f"строка {line}: {error}")
+    return rows, errors
+
+
+def read_catalog_chunks(path: str, chunk_rows: int = 50_000, fmt: Optional[str] = None
+                        ) -> Iterator[Tuple[List, int, Optional[List[str]]]]:
+    """
+    Потоково читает фид CSV (с заголовком) или JSONL частями по chunk_rows записей.
+    :param fmt: 'csv' или 'jsonl', по умолчанию по расширению файла
+    :returns: аргументы parse_catalog_chunk для каждой части
+    """
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8', newline='' if fmt == 'csv' else None) as file:
+        if fmt == 'csv':
+            reader = csv.reader(file)
+            header = [field.strip() for field in next(reader, [])]
+            unknown = set(header) - set(CATALOG_FIELDS)
+            if unknown:
+                raise ValueError(f"Неизвестные колонки фида: {', '.join(sorted(unknown))}")
+            missing = {'name', 'price', 'quantity'} - set(header)
+            if missing:
+                raise ValueError(f"В фиде нет колонок: {', '.join(sorted(missing))}")
+            records = reader
+        else:
+            header = None
+            records = file
+        line = 2 if header is not None else 1
+        while True:
+            chunk = list(islice(records, chunk_rows))
+            if not chunk:
+                return
+            yield chunk, line, header
+            # Для CSV номер считается по записям: поле в кавычках может занимать несколько строк
+            line += len(chunk)
+
+
+def load_catalog(storage: Storage, path: str, chunk_rows: int = 50_000, fmt: Optional[str] = None,
+                 workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Загружает фид товаров в склад частями. Товар, уже бывший на складе или встреченный
+    в фиде повторно, пополняется как в add_product: прибавляется только количество.
+    Ошибочные записи пропускаются.
+    :param workers: если задан, части разбираются в пуле из workers процессов
+    :param max_in_flight: сколько частей одновременно в пуле, по умолчанию 2 * workers
+    :returns: число записей, новых и пополненных товаров и список ошибок
+    """
+    report = {"records": 0, "added": 0, "merged": 0, "errors": []}
+
+    def apply(rows, errors):
+        added = storage.add_rows(rows)
+        report["records"] += len(rows) + len(errors)
+        report["added"] += added
+        report["merged"] += len(rows) - added
+        report["errors"].extend(errors)
+
+    chunks = read_catalog_chunks(path, chunk_rows, fmt)
+    if not workers:
+        for chunk in chunks:
+            apply(*parse_catalog_chunk(*chunk))
+        return report
+
+    max_in_flight = max_in_flight or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Части применяются в порядке файла, чтобы повторы сливались так же, как без пула
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= max_in_flight:
+                apply(*pending.popleft().result())
+            pending.append(pool.submit(parse_catalog_chunk, *chunk))
+        while pending:
+            apply(*pending.popleft().result())
+    return report
+
+
+class AsyncStorage:
+    """
+    Асинхронный фасад над Storage для asyncio-сервисов.
+    Запросы get_product и add_item, пришедшие за один проход цикла событий, выполняются
+    одним пакетом в следующем проходе: одинаковые get_product отвечаются одним поиском,
+    а для ConcurrentStorage блокировки всех товаров пакета берутся один раз.
+    Не больше max_pending запросов выполняются одновременно, остальные ждут места в порядке очереди
+    (backpressure). Запрос с истёкшим timeout получает asyncio.TimeoutError и не выполняется,
+    если его пакет ещё не начался.
+    """
+
+    def __init__(self, storage: Storage, max_pending: int = 1024):
+        self.storage = storage
+        self._free = max_pending
+        # Запросы, ждущие места; asyncio.Semaphore будит ожидающих за O(n) от их числа
+        self._waiters: deque = deque()
+        # (future, имя товара, корзина или None для get_product, количество, рецепт)
+        self._batch: List[tuple] = []
+        self.batches = 0
+
+    async def get_product(self, name: str, timeout: Optional[float] = None) -> Optional[CombinedProduct]:
+        return await self._submit((name, None, 0, False), timeout)
+
+    async def add_item(self, cart: Cart, product_name: str, quantity: int, has_prescription: bool = False,
+                       timeout: Optional[float] = None) -> List[str]:
+        """
+        Cart.add_item в пакете
+        :returns: Список причин по которым продукт не был продан.
+        :raises asyncio.TimeoutError: если запрос не успел выполниться за timeout секунд
+        """
+        return await self._submit((product_name, cart, quantity, has_prescription), timeout)
+
+    async def _submit(self, request: tuple, timeout: Optional[float]):
+        loop = asyncio.get_running_loop()
+        # Один таймер на весь запрос: ожидание места в очереди тоже входит в timeout.
+        # asyncio.wait_for не используется, он создаёт задачу на каждый вызов
+        future = loop.create_future()
+        expire = None if timeout is None else loop.call_later(timeout, self._expire, future)
+        try:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+            else:
+                slot = loop.create_future()
+                self._waiters.append(slot)
+                future.add_done_callback(lambda _: slot.done() or slot.cancel())
+                try:
+                    await slot
+                except asyncio.CancelledError:
+                    if slot.done() and not slot.cancelled():
+                        # Место выдано, но задачу отменили раньше, чем она его заняла
+                        self._release()
+                    elif future.done() and not future.cancelled():
+                        # Место так и не получено, потому что истёк timeout
+                        future.result()
+                    raise
+            try:
+                if not self._batch:
+                    loop.call_soon(self._flush)
+                self._batch.append((future,) + request)
+                return await future
+            finally:
+                self._release()
+        finally:
+            if expire is not None:
+                expire.cancel()
+
+    def _release(self):
+        # Место передаётся первому живому ожидающему
+        while self._waiters:
+            slot = self._waiters.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self._free += 1
+
+    @staticmethod
+    def _expire(future: asyncio.Future):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        batch = [request for request in batch if not request[0].done()]
+        if not batch:
+            return
+        self.batches += 1
+        found = {}
+        with self.storage._lock({request[1] for request in batch}):
+            for future, name, cart, quantity, has_prescription in batch:
+                try:
+                    if cart is None:
+                        if name not in found:
+                            found[name] = self.storage.get_product(name)
+                        result = found[name]
+                    else:
+                        result = cart.add_item(name, quantity, has_prescription)
+                        # Остаток изменился, повторный get_product в пакете должен его увидеть
+                        found.pop(name, None)
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
 
 
 if __name__ == "__main__":
@@ -318,10 +1811,10 @@ if __name__ == "__main__":
     b, f, c, cal = cart.total_bju_calories()
     print(f"Суммарные БЖУ и калории: Белки={b:.2f}, Жиры={f:.2f}, Углеводы={c:.2f}, Калории={cal}")
 
-    norm_warnings = cart.check_norms()
-    if norm_warnings:
+    norm_msgs = cart.check_norms()
+    if norm_msgs:
         print("Предупреждения по нормам:")
-        for w in norm_warnings:
+        for w in norm_msgs:
             print("-", w)
     else:
         print("Нормы БЖУ и калорий не превышены.")
@@ -333,3 +1826,44 @@ if __name__ == "__main__":
     print("\nТовары, которые необходимо утилизировать:")
     for p in st.products_to_dispose():
         print("-", p)
+
+    print("\nТовары, которые испортятся в ближайшие 48 часов:")
+    for p in st.products_expiring_within(timedelta(hours=48)):
+        print("-", p)
+
+    # Восстановление DurableStorage: после снимка и после оборванной записи в конце журнала
+    import tempfile
+
+    def durable_state(directory):
+        with DurableStorage(directory) as durable:
+            product = durable.get_product("Яблоко")
+            return product.quantity, product.price
+
+    with tempfile.TemporaryDirectory() as directory:
+        with DurableStorage(directory) as durable:
+            durable.add_product(CombinedProduct("Яблоко", 50, 100))
+            durable.checkpoint()
+            durable.change_quantity("Яблоко", -30)
+            durable.set_price("Яблоко", 60)
+        recovery_checks = [("снимок и журнал после checkpoint", durable_state(directory), (70, 60))]
+
+        with DurableStorage(directory) as durable:
+            durable.checkpoint()
+        recovery_checks.append(("только снимок", durable_state(directory), (70, 60)))
+
+        with DurableStorage(directory) as durable:
+            durable.change_quantity("Яблоко", -5)
+            durable.change_quantity("Яблоко", -1)
+        wal_path = os.path.join(directory, 'wal.bin')
+        os.truncate(wal_path, os.path.getsize(wal_path) - 3)
+        recovery_checks.append(("оборванная последняя запись", durable_state(directory), (65, 60)))
+
+        with DurableStorage(directory) as durable:
+            durable.change_quantity("Яблоко", -2)
+        recovery_checks.append(("дозапись после обрезки хвоста", durable_state(directory), (63, 60)))
+
+    print("\nВосстановление склада с диска:")
+    for i, (name, result, expected) in enumerate(recovery_checks):
+        print("=" * 10, i + 1, sep="\n")
+        print("+" if result == expected else "-")
+        print(f"Проверка: {name}", f"Результат: {result}", f"Ожидаемый результат: {expected}", sep="\n")
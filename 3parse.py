@@ -1,42 +1,406 @@
+import argparse
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
 import re
+import sqlite3
+import zlib
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from html import unescape
+from typing import Iterable, Iterator, Optional
 
+# metrics.py лежит рядом: скрипт запускается из каталога репозитория или с ним в PYTHONPATH
+from metrics import METRICS
 
+# Теги, содержимое которых не является видимым текстом
+RAW_TEXT_TAGS = ('script', 'style', 'textarea')
+_NEED_MORE = -2
+_NO_MORE_TAGS = -3
+
+
+@METRICS.traced('parse.remove_html_tags')
 def remove_html_tags(text: str):
     """
-    Удаляет все HTML-теги и содержимое тегов style, script и textarea
+    Удаляет все HTML-теги и содержимое тегов style, script и textarea за один проход
+    """
+    # Теги заменяются пробелом, пробельные символы схлопываются в один
+    tokens = HtmlTextTokenizer(max_pending=None).close(text)
+    return unescape(' '.join(tokens)).strip()
+
+
+class HtmlTextTokenizer:
     """
-    # Удаляем содержимое тегов <script> и <style>
-    text = re.sub(r'<(script|style|textarea)[^>]*>.*?</\1>', ' ', text, flags=re.DOTALL)
-    # Удаляем все оставшиеся HTML-теги
-    text = re.sub(r'<[^>]+>', ' ', text)
-    # Заменяем множественные пробелы на один
-    text = re.sub(r'\s+', ' ', text)
-    return unescape(text).strip()
+    Конечный автомат, который принимает HTML кусками (feed) и отдаёт видимый текст,
+    разбитый по пробельным символам на токены. Теги, блоки script/style/textarea и
+    сущности, разрезанные границей куска, дожидаются следующего куска.
+
+    Разбор повторяет прежний каскад регулярных выражений: сначала вырезаются блоки
+    script/style/textarea (в том числе начатые внутри тега), затем теги вида <[^>]+>.
+    Незавершённая конструкция длиннее max_pending символов считается закрытой
+    где-то дальше и пропускается без буферизации, чтобы память не росла.
+    """
+
+    _LT, _GT, _EMPTY = '<', '>', ''
+    _RAW_TAGS = RAW_TEXT_TAGS
+    _CLOSINGS = {name: f'</{name}>' for name in RAW_TEXT_TAGS}
+
+    def __init__(self, max_pending: Optional[int] = 1 << 20):
+        self.max_pending = max_pending
+        self._buf = self._EMPTY
+        # Маркер конца пропускаемой конструкции ('>' или '</script>' и т.п.)
+        self._skip_until: Optional[str] = None
+        # Тег -> позиция, после которой закрывающего тега точно нет (только для close)
+        self._no_close: dict[str, int] = {}
+
+    def feed(self, chunk: str) -> list[str]:
+        """
+        :param chunk: очередной кусок документа
+        :returns: завершённые токены видимого текста
+        """
+        return self._process(self._buf + chunk, final=False)
+
+    def close(self, chunk: Optional[str] = None) -> list[str]:
+        """
+        :param chunk: последний кусок документа
+        :returns: оставшиеся токены видимого текста
+        """
+        self._no_close = {}
+        return self._process(self._buf + (chunk or self._EMPTY), final=True)
+
+    def text_spans(self, buf):
+        """
+        Перечисляет границы (start, end) отрезков видимого текста в документе целиком,
+        не копируя его (buf может быть mmap)
+        """
+        self._no_close = {}
+        pos = run_start = 0
+        while (lt := buf.find(self._LT, pos)) >= 0:
+            end = self._raw_block_end(buf, lt, True)
+            if end == -1:
+                end = self._tag_end(buf, lt, True)
+            if end == _NO_MORE_TAGS:
+                break
+            if end == -1:
+                pos = lt + 1
+                continue
+            yield run_start, lt
+            run_start = pos = end
+        yield run_start, len(buf)
+
+    def _raw_block_end(self, buf: str, lt: int, final: bool) -> int:
+        """
+        :returns: позиция за закрывающим тегом блока script/style/textarea, начатого в lt,
+        -1 если в lt такой блок не начинается, _NEED_MORE если данных не хватает
+        """
+        head = buf[lt + 1:lt + 9]
+        for name in self._RAW_TAGS:
+            if head.startswith(name):
+                break
+        else:
+            if not final and any(len(head) < len(name) and name.startswith(head) for name in self._RAW_TAGS):
+                return _NEED_MORE
+            return -1
+
+        gt = buf.find(self._GT, lt + 1 + len(name))
+        if gt < 0:
+            return -1 if final else _NEED_MORE
+        if self._no_close.get(name, len(buf)) <= gt:
+            return -1
+        closing = self._CLOSINGS[name]
+        end = buf.find(closing, gt + 1)
+        if end < 0:
+            if not final:
+                return _NEED_MORE
+            self._no_close[name] = gt
+            return -1
+        return end + len(closing)
+
+    def _tag_end(self, buf: str, lt: int, final: bool) -> int:
+        """
+        :returns: позиция за тегом, начатым в lt, -1 если '<' это обычный символ,
+        _NEED_MORE если данных не хватает, _NO_MORE_TAGS если '>' дальше нет
+        """
+        gt = buf.find(self._GT, lt + 1)
+        if gt < 0:
+            return _NO_MORE_TAGS if final else _NEED_MORE
+        if gt == lt + 1:
+            return -1
+        # Блоки script/style/textarea внутри тега удаляются раньше самого тега
+        inner = buf.find(self._LT, lt + 1, gt)
+        while inner >= 0:
+            end = self._raw_block_end(buf, inner, final)
+            if end == _NEED_MORE:
+                return _NEED_MORE
+            if end < 0:
+                inner = buf.find(self._LT, inner + 1, gt)
+                continue
+            gt = buf.find(self._GT, end)
+            if gt < 0:
+                return -1 if final else _NEED_MORE
+            inner = buf.find(self._LT, end, gt)
+        return gt + 1
+
+    def _process(self, buf: str, final: bool) -> list[str]:
+        tokens: list[str] = []
+        pos = 0
+        if self._skip_until is not None:
+            end = buf.find(self._skip_until)
+            if end < 0:
+                keep = len(self._skip_until) - 1
+                self._buf = buf[len(buf) - keep:] if keep and not final else self._EMPTY
+                return tokens
+            pos = end + len(self._skip_until)
+            self._skip_until = None
+
+        run_start = pos
+        while (lt := buf.find(self._LT, pos)) >= 0:
+            end = self._raw_block_end(buf, lt, final)
+            if end == -1:
+                end = self._tag_end(buf, lt, final)
+            if end == _NO_MORE_TAGS:
+                break
+            if end == -1:
+                pos = lt + 1
+                continue
+            if end == _NEED_MORE:
+                if self.max_pending is not None and len(buf) - lt > self.max_pending:
+                    # Слишком длинная конструкция: пропускаем её, не храня в памяти
+                    tokens.extend(buf[run_start:lt].split())
+                    name = next((t for t in self._RAW_TAGS if buf.startswith(t, lt + 1)), None)
+                    self._skip_until = self._CLOSINGS[name] if name else self._GT
+                    return tokens + self._process(buf[lt + 1:], final)
+                partial = self._split_run(buf[run_start:lt], tokens)
+                self._buf = partial + buf[lt:]
+                return tokens
+            tokens.extend(buf[run_start:lt].split())
+            run_start = pos = end
+
+        if final:
+            tokens.extend(buf[run_start:].split())
+            self._buf = self._EMPTY
+        else:
+            self._buf = self._split_run(buf[run_start:], tokens)
+        return tokens
 
+    def _split_run(self, run: str, tokens: list[str]) -> str:
+        """
+        Добавляет в tokens завершённые токены отрезка текста
+        :returns: незавершённый последний токен
+        """
+        parts = run.split()
+        if not parts or run[-1:].isspace():
+            tokens.extend(parts)
+            return self._EMPTY
+        partial = parts.pop()
+        tokens.extend(parts)
+        if self.max_pending is not None and len(partial) > self.max_pending:
+            tokens.append(partial)
+            return self._EMPTY
+        return partial
 
+
+class HtmlBytesTokenizer(HtmlTextTokenizer):
+    """
+    HtmlTextTokenizer над байтами UTF-8 (bytes или mmap).
+    Токены разделяются только ASCII-пробелами.
+    """
+
+    _LT, _GT, _EMPTY = b'<', b'>', b''
+    _RAW_TAGS = tuple(name.encode() for name in RAW_TEXT_TAGS)
+    _CLOSINGS = {name: b'</' + name + b'>' for name in _RAW_TAGS}
+
+
+@METRICS.traced('parse.get_words')
 def get_words(text: str):
     """Извлекает слова из текста (только буквы, минимум 3 символа)"""
     words = re.findall(r'\b[a-zA-Zа-яА-ЯёЁ]{3,}\b', text, flags=re.IGNORECASE)
     return [word.lower() for word in words]
 
 
-def count_words(words: list[str]) -> defaultdict[str, int]:
-    """Подсчитывает частоту слов"""
-    word_counts = defaultdict(int)
+# То же слово, что в get_words, но над байтами UTF-8: буквы a-z и а-яё в любом регистре,
+# а границей слова считается любой символ, кроме ASCII-букв, цифр, '_' и кириллицы U+0400-U+04FF
+_UTF8_LETTER = rb'(?:[A-Za-z]|\xd0[\x81\x90-\xbf]|\xd1[\x80-\x8f\x91])'
+WORD_BYTES_RE = re.compile(rb'(?<![A-Za-z0-9_])(?<![\xd0-\xd3][\x80-\xbf])'
+                           + _UTF8_LETTER + rb'{3,}(?![A-Za-z0-9_\xd0-\xd3])')
+
+
+class SpaceSavingCounter:
+    """
+    Приближённый счётчик частот с фиксированным объёмом памяти (алгоритм Space-Saving):
+    хранится не более capacity слов, новое слово вытесняет самое редкое.
+
+    Если всего подсчитано N слов, оценка частоты завышена не более чем на N / capacity
+    (точная величина для слова в errors), а любое слово с частотой больше N / capacity
+    гарантированно присутствует в счётчике.
+    Поддерживает word_counts[word] += k, поэтому подходит для count_words.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity должна быть положительной")
+        self.capacity = capacity
+        self.total = 0
+        self.counts: dict[str, int] = {}
+        # Слово -> на сколько может быть завышена его частота
+        self.errors: dict[str, int] = {}
+        # Частота -> слова с такой частотой, чтобы находить самое редкое за O(1)
+        self._buckets: dict[int, set[str]] = {}
+        # Частоты корзин в куче с ленивым удалением: новый минимум после опустевшей корзины
+        # находится за O(log k) амортизированно, а не перебором k различных частот
+        self._heap: list[int] = []
+        self._min = 0
+
+    def __getitem__(self, word: str) -> int:
+        count = self.counts.get(word)
+        if count is not None:
+            return count
+        # Для отсутствующего слова верхняя оценка - минимальная частота
+        return self._min if len(self.counts) >= self.capacity else 0
+
+    def __setitem__(self, word: str, count: int):
+        old = self.counts.get(word)
+        self.total += count - self[word]
+        if old is None:
+            if len(self.counts) >= self.capacity:
+                self.errors[word] = self._min
+                victim = next(iter(self._buckets[self._min]))
+                self._discard(victim, self._min)
+                del self.counts[victim]
+                del self.errors[victim]
+            else:
+                self.errors[word] = 0
+        else:
+            self._discard(word, old)
+
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = set()
+            self._push(count)
+        bucket.add(word)
+        self.counts[word] = count
+        if count < self._min or len(self.counts) == 1:
+            self._min = count
+        elif self._min not in self._buckets:
+            self._min = self._min + 1 if self._min + 1 in self._buckets else self._pop_min()
+
+    def _push(self, count: int):
+        heap = self._heap
+        if len(heap) > 2 * len(self._buckets) + 64:
+            # Устаревших частот стало больше живых: собираем кучу заново
+            heap[:] = self._buckets
+            heapq.heapify(heap)
+        else:
+            heapq.heappush(heap, count)
+
+    def _pop_min(self) -> int:
+        heap = self._heap
+        while heap[0] not in self._buckets:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def _discard(self, word: str, count: int):
+        bucket = self._buckets[count]
+        bucket.discard(word)
+        if not bucket:
+            del self._buckets[count]
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.counts
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def items(self):
+        return self.counts.items()
+
+    def max_error(self) -> float:
+        """:returns: гарантированная граница ошибки N / capacity"""
+        return self.total / self.capacity
+
+
+@METRICS.traced('parse.count_words')
+def count_words(words: list[str],
+                word_counts: Optional[defaultdict[str, int] | SpaceSavingCounter] = None
+                ) -> defaultdict[str, int] | SpaceSavingCounter:
+    """Подсчитывает частоту слов, при переданном word_counts дополняет его"""
+    if word_counts is None:
+        word_counts = defaultdict(int)
     for word in words:
         word_counts[word] += 1
     return word_counts
 
 
-def get_top_words(file_path: str, n: int = 15) -> list[tuple[str, int]]:
+def count_words_stream(file_path: str, chunk_size: int = 1 << 16,
+                       word_counts: Optional[defaultdict[str, int] | SpaceSavingCounter] = None
+                       ) -> defaultdict[str, int] | SpaceSavingCounter:
     """
+    Подсчитывает частоту слов, читая файл кусками: память не зависит от размера файла
     :param file_path: путь к файлу
-    :param n: кол-во слов
-    :returns: топ-N самых частых слов
+    :param chunk_size: размер куска в символах
+    :param word_counts: счётчик, который нужно дополнить
     """
+    tokenizer = HtmlTextTokenizer()
+    if word_counts is None:
+        word_counts = defaultdict(int)
+    with open(file_path, 'r', encoding='utf-8') as file:
+        while chunk := file.read(chunk_size):
+            count_words(get_words(unescape(' '.join(tokenizer.feed(chunk)))), word_counts)
+    count_words(get_words(unescape(' '.join(tokenizer.close()))), word_counts)
+    return word_counts
+
+
+@METRICS.traced('parse.count_words_mmap')
+def count_words_mmap(file_path: str,
+                     word_counts: Optional[defaultdict[str, int] | SpaceSavingCounter] = None
+                     ) -> defaultdict[str, int] | SpaceSavingCounter:
+    """
+    Подсчитывает частоту слов без декодирования файла: файл отображается в память,
+    теги пропускаются и слова ищутся прямо в байтах UTF-8, список слов не строится.
+    В отличие от get_words, прочие не-ASCII буквы (é, ї) считаются разделителями.
+    :param file_path: путь к файлу
+    :param word_counts: счётчик, который нужно дополнить
+    """
+    if word_counts is None:
+        word_counts = defaultdict(int)
+    if os.path.getsize(file_path) == 0:
+        return word_counts
+
+    # Слово в исходном регистре -> частота, к нижнему регистру приводится один раз на словоформу
+    raw_counts = defaultdict(int)
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end in HtmlBytesTokenizer().text_spans(mm):
+            if mm.find(b'&', start, end) >= 0:
+                # Сущности раскрываем в str, такие отрезки короткие
+                count_words(get_words(unescape(mm[start:end].decode('utf-8', 'replace'))), word_counts)
+                continue
+            for match in WORD_BYTES_RE.finditer(mm, start, end):
+                raw_counts[match[0]] += 1
+
+    for raw, count in raw_counts.items():
+        word_counts[raw.decode('utf-8').lower()] += count
+    return word_counts
+
+
+def count_file_words(file_path: str, chunk_size: Optional[int] = None,
+                     word_counts: Optional[defaultdict[str, int] | SpaceSavingCounter] = None,
+                     use_mmap: bool = False) -> defaultdict[str, int] | SpaceSavingCounter:
+    """
+    Подсчитывает частоту слов в HTML файле
+    :param file_path: путь к файлу
+    :param chunk_size: если задан, файл читается потоково кусками такого размера
+    :param word_counts: счётчик, который нужно дополнить
+    :param use_mmap: искать слова в байтах отображённого в память файла (count_words_mmap)
+    """
+    if use_mmap:
+        return count_words_mmap(file_path, word_counts)
+    if chunk_size:
+        return count_words_stream(file_path, chunk_size, word_counts)
+
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             html_content = file.read()
@@ -45,22 +409,558 @@ def get_top_words(file_path: str, n: int = 15) -> list[tuple[str, int]]:
 
     text_without_tags = remove_html_tags(html_content)  # type: ignore
     words = get_words(text_without_tags)
-    word_counts = count_words(words)
-    top_words = sorted(word_counts.items(), key=lambda x: (-x[1], x[0]))
-    return top_words[:n]
+    return count_words(words, word_counts)
+
+
+@METRICS.traced('parse.top_n')
+def top_n(word_counts: defaultdict[str, int] | SpaceSavingCounter, n: int) -> list[tuple[str, int]]:
+    """
+    Выбирает топ-N кучей за O(V log N) вместо полной сортировки словаря
+    :returns: пары (слово, частота) по убыванию частоты, при равенстве по алфавиту
+    """
+    return heapq.nsmallest(n, word_counts.items(), key=lambda x: (-x[1], x[0]))
+
+
+@METRICS.traced('parse.get_top_words')
+def get_top_words(file_path: str, n: int = 15, chunk_size: Optional[int] = None,
+                  max_words: Optional[int] = None, use_mmap: bool = False) -> list[tuple[str, int]]:
+    """
+    :param file_path: путь к файлу
+    :param n: кол-во слов
+    :param chunk_size: если задан, файл читается потоково кусками такого размера
+    :param max_words: если задан, частоты считаются приближённо в SpaceSavingCounter такого размера
+    :param use_mmap: искать слова в байтах отображённого в память файла
+    :returns: топ-N самых частых слов
+    """
+    word_counts = SpaceSavingCounter(max_words) if max_words else None
+    return top_n(count_file_words(file_path, chunk_size, word_counts, use_mmap), n)
+
+
+class WordCountCache:
+    """
+    Дисковый кэш частот слов по файлам (SQLite), отдельно для каждого способа подсчёта (use_mmap):
+    они по-разному делят текст на слова. Файл с прежними размером и mtime не читается вовсе. Если метаданные изменились,
+    сравнивается хэш содержимого, и заново разбираются только реально изменённые файлы.
+    При превышении max_entries записей или max_bytes данных старые записи вытесняются по LRU.
+    Новые записи фиксируются каждые commit_every штук, так что прерванный прогон теряет не больше их.
+    """
+
+    def __init__(self, db_path: str, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 commit_every: int = 100):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        # Записей с последней фиксации
+        self._uncommitted = 0
+        self.db = sqlite3.connect(db_path)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(word_counts)")]
+        if columns and 'mmap' not in columns:
+            # Кэш без способа подсчёта: неизвестно, каким подсчитаны записи
+            self.db.execute("DROP TABLE word_counts")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS word_counts (
+            path TEXT NOT NULL,
+            mmap INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            digest BLOB NOT NULL,
+            counts BLOB NOT NULL,
+            last_used INTEGER NOT NULL,
+            PRIMARY KEY (path, mmap))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS word_counts_digest ON word_counts (digest, mmap)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS word_counts_last_used ON word_counts (last_used)")
+        # Логические часы для LRU: не зависят от системного времени
+        self._clock = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM word_counts").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def file_digest(file_path: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as file:
+            while block := file.read(1 << 20):
+                digest.update(block)
+        return digest.digest()
+
+    def lookup(self, file_path: str,
+               use_mmap: bool = False) -> tuple[Optional[dict[str, int]], tuple[int, int, Optional[bytes], bool]]:
+        """
+        :param use_mmap: частоты, подсчитанные count_words_mmap, а не по тексту
+        :returns: частоты слов из кэша (или None) и ключ (размер, mtime, хэш, use_mmap) для store
+        """
+        stat = os.stat(file_path)
+        self._clock += 1
+        row = self.db.execute("SELECT size, mtime_ns, counts FROM word_counts WHERE path = ? AND mmap = ?",
+                              (file_path, use_mmap)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            self.db.execute("UPDATE word_counts SET last_used = ? WHERE path = ? AND mmap = ?",
+                            (self._clock, file_path, use_mmap))
+            self.hits += 1
+            return self._decode(row[2]), (stat.st_size, stat.st_mtime_ns, None, use_mmap)
+
+        # Метаданные изменились: то же содержимое могло быть закэшировано под любым путём
+        digest = self.file_digest(file_path)
+        key = (stat.st_size, stat.st_mtime_ns, digest, use_mmap)
+        row = self.db.execute("SELECT counts FROM word_counts WHERE digest = ? AND mmap = ? LIMIT 1",
+                              (digest, use_mmap)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None, key
+        self._put(file_path, key, row[0])
+        self.hits += 1
+        return self._decode(row[0]), key
+
+    def store(self, file_path: str, key: tuple[int, int, Optional[bytes], bool], word_counts: dict[str, int]):
+        """
+        Сохраняет частоты слов файла по ключу, полученному из lookup
+        """
+        self._clock += 1
+        data = zlib.compress(json.dumps(word_counts, ensure_ascii=False).encode('utf-8'))
+        self._put(file_path, key, data)
+
+    def _put(self, file_path: str, key: tuple[int, int, Optional[bytes], bool], data: bytes):
+        size, mtime_ns, digest, use_mmap = key
+        self.db.execute("INSERT OR REPLACE INTO word_counts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (file_path, use_mmap, size, mtime_ns, digest, data, self._clock))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self._uncommitted = 0
+
+    @staticmethod
+    def _decode(data: bytes) -> dict[str, int]:
+        return json.loads(zlib.decompress(data))
+
+    def count_file_words(self, file_path: str, chunk_size: Optional[int] = None,
+                         use_mmap: bool = False) -> dict[str, int]:
+        """
+        То же, что count_file_words, но с кэшем
+        """
+        word_counts, key = self.lookup(file_path, use_mmap)
+        if word_counts is None:
+            word_counts = dict(count_file_words(file_path, chunk_size, use_mmap=use_mmap))
+            self.store(file_path, key, word_counts)
+        return word_counts
+
+    def evict(self):
+        """
+        Удаляет давно не использованные записи сверх max_entries и max_bytes
+        """
+        if self.max_entries is not None:
+            self.db.execute("""DELETE FROM word_counts WHERE rowid IN (
+                SELECT rowid FROM word_counts ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+        if self.max_bytes is not None:
+            total = 0
+            rows = self.db.execute("SELECT rowid, LENGTH(counts) FROM word_counts ORDER BY last_used DESC")
+            stale = []
+            for rowid, size in rows:
+                total += size
+                if total > self.max_bytes:
+                    stale.append((rowid,))
+            self.db.executemany("DELETE FROM word_counts WHERE rowid = ?", stale)
+        self.commit()
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+
+def find_html_files(source: str) -> list[str]:
+    """
+    :param source: директория (берутся все *.html рекурсивно) или glob-шаблон
+    :returns: отсортированный список файлов
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '**', '*.html')
+    return sorted(path for path in glob.iglob(source, recursive=True) if os.path.isfile(path))
+
+
+def _count_file_words_plain(file_path: str, chunk_size: Optional[int], use_mmap: bool) -> dict[str, int]:
+    # Обычный dict дешевле передавать между процессами
+    return dict(count_file_words(file_path, chunk_size, use_mmap=use_mmap))
+
+
+def count_corpus_words(file_paths: Iterable[str], workers: Optional[int] = None,
+                       max_in_flight: Optional[int] = None,
+                       chunk_size: Optional[int] = None,
+                       max_words: Optional[int] = None,
+                       cache: Optional[WordCountCache] = None,
+                       use_mmap: bool = False) -> defaultdict[str, int] | SpaceSavingCounter:
+    """
+    Подсчитывает частоту слов по множеству файлов в пуле процессов
+    :param file_paths: пути к файлам
+    :param workers: кол-во процессов, по умолчанию по числу ядер
+    :param max_in_flight: сколько файлов одновременно в обработке, по умолчанию 2 * workers
+    :param chunk_size: если задан, каждый файл читается потоково
+    :param max_words: если задан, суммарные частоты считаются приближённо в SpaceSavingCounter
+    :param cache: кэш частот, неизменённые файлы берутся из него без разбора
+    :param use_mmap: искать слова в байтах отображённых в память файлов
+    :returns: суммарная частота слов
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    word_counts = SpaceSavingCounter(max_words) if max_words else defaultdict(int)
+    # Задача -> путь и ключ кэша
+    cache_keys = {}
+
+    def merge(file_counts):
+        for word, count in file_counts.items():
+            word_counts[word] += count
+
+    def merge_done(futures):
+        for future in futures:
+            file_path, key = cache_keys.pop(future)
+            file_counts = future.result()
+            if cache is not None:
+                cache.store(file_path, key, file_counts)
+            merge(file_counts)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for file_path in file_paths:
+            key = None
+            if cache is not None:
+                cached, key = cache.lookup(file_path, use_mmap)
+                if cached is not None:
+                    merge(cached)
+                    continue
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                merge_done(done)
+            future = pool.submit(_count_file_words_plain, file_path, chunk_size, use_mmap)
+            cache_keys[future] = (file_path, key)
+            pending.add(future)
+        merge_done(wait(pending).done)
+    if cache is not None:
+        cache.commit()
+    return word_counts
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_postings(postings: Iterable[tuple[int, int]]) -> bytes:
+    """
+    Сжимает список вхождений слова: пары (id документа, частота) упорядочиваются по убыванию частоты,
+    затем по id, и пишутся varint-ами: первая частота, затем для каждой пары падение частоты
+    и id (разность с предыдущим id, если частота не упала). Типичная пара занимает 2 байта.
+    """
+    out = bytearray()
+    prev_count = prev_doc = None
+    for doc, count in sorted(postings, key=lambda p: (-p[1], p[0])):
+        if prev_count is None:
+            _write_varint(out, count)
+            prev_count = count
+        drop = prev_count - count
+        if drop or prev_doc is None:
+            prev_doc = 0
+        _write_varint(out, drop)
+        _write_varint(out, doc - prev_doc)
+        prev_count, prev_doc = count, doc
+    return bytes(out)
+
+
+def decode_postings(data: bytes) -> Iterator[tuple[int, int]]:
+    """
+    Обратное к encode_postings, лениво: чтение первых пар не разбирает остальные
+    :returns: пары (-частота, id документа) в порядке хранения, удобном для heapq.merge
+    """
+    values = []
+    value = shift = 0
+    count = doc = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = shift = 0
+        if len(values) == 1:
+            count = values[0]
+        elif len(values) == 3:
+            drop, delta = values[1], values[2]
+            del values[1:]
+            if drop:
+                count -= drop
+                doc = 0
+            doc += delta
+            yield -count, doc
+
+
+def _count_files(file_paths: Iterable[str], workers: Optional[int], max_in_flight: Optional[int],
+                 chunk_size: Optional[int], use_mmap: bool) -> Iterator[tuple[str, dict[str, int]]]:
+    """
+    Частоты слов файлов, посчитанные в пуле процессов, как в count_corpus_words
+    :returns: пары (путь, частоты) в порядке завершения
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for file_path in file_paths:
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[pool.submit(_count_file_words_plain, file_path, chunk_size, use_mmap)] = file_path
+        for future in wait(pending).done:
+            yield pending[future], future.result()
+
+
+class WordIndex:
+    """
+    Дисковый инвертированный индекс (SQLite): слово -> документы с частотой слова в них.
+    Слова берутся так же, как в get_top_words (count_file_words).
+
+    Документы добавляются пачками: вхождения пачки по каждому слову пишутся одним сжатым
+    сегментом (encode_postings), упорядоченным по убыванию частоты. Запрос слова читает его сегменты
+    по первичному ключу и лениво сливает их, поэтому топ документов не разбирает весь список.
+    Удалённые документы помечаются в таблице deleted и пропускаются при чтении, пока compact
+    не перепишет сегменты; он же сливает сегменты, когда их у слова больше max_segments.
+    """
+
+    def __init__(self, db_path: str, batch_postings: int = 1_000_000, max_segments: int = 32):
+        """
+        :param batch_postings: сколько пар (слово, документ) копить в памяти до записи сегмента
+        :param max_segments: после скольких сегментов add вызывает compact
+        """
+        self.batch_postings = batch_postings
+        self.max_segments = max_segments
+        self.db = sqlite3.connect(db_path)
+        # AUTOINCREMENT: id удалённого документа не достаётся новому, пока его вхождения не вычищены
+        self.db.execute("""CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            words INTEGER NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS postings (
+            word TEXT NOT NULL,
+            segment INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (word, segment)) WITHOUT ROWID""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS deleted (id INTEGER PRIMARY KEY)")
+        self.deleted = {row[0] for row in self.db.execute("SELECT id FROM deleted")}
+        self.segments = {row[0] for row in self.db.execute("SELECT id FROM segments")}
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def add(self, file_paths: Iterable[str], workers: Optional[int] = None,
+            max_in_flight: Optional[int] = None, chunk_size: Optional[int] = None,
+            use_mmap: bool = False) -> int:
+        """
+        Индексирует файлы. Файлы с прежними размером и mtime пропускаются,
+        изменённые индексируются заново (старая версия удаляется).
+        Параметры разбора - как у count_corpus_words.
+        :returns: сколько файлов проиндексировано
+        """
+        stale = []
+        changed = {}
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            row = self.db.execute("SELECT size, mtime_ns FROM documents WHERE path = ?", (file_path,)).fetchone()
+            if row == (stat.st_size, stat.st_mtime_ns):
+                continue
+            if row is not None:
+                stale.append(file_path)
+            changed[file_path] = (stat.st_size, stat.st_mtime_ns)
+        if not changed:
+            return 0
+        self.remove(stale)
+
+        documents = []
+        # Слово -> пары (номер документа в пачке, частота)
+        postings = defaultdict(list)
+        batch = 0
+        for file_path, word_counts in _count_files(changed, workers, max_in_flight, chunk_size, use_mmap):
+            number = len(documents)
+            documents.append((file_path, *changed[file_path], sum(word_counts.values())))
+            for word, count in word_counts.items():
+                postings[word].append((number, count))
+            batch += len(word_counts)
+            if batch >= self.batch_postings:
+                self._write_segment(documents, postings)
+                documents, postings, batch = [], defaultdict(list), 0
+        if documents:
+            self._write_segment(documents, postings)
+        if len(self.segments) > self.max_segments:
+            self.compact()
+        return len(changed)
+
+    def _write_segment(self, documents: list[tuple[str, int, int, int]], postings: dict[str, list[tuple[int, int]]]):
+        """
+        Записывает документы пачки и их вхождения новым сегментом в одной транзакции
+        """
+        segment = max(self.segments, default=0) + 1
+        with self.db:
+            ids = [self.db.execute("INSERT INTO documents (path, size, mtime_ns, words) VALUES (?, ?, ?, ?)",
+                                   document).lastrowid for document in documents]
+            self.db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                ((word, segment, encode_postings((ids[number], count) for number, count in pairs))
+                                 for word, pairs in postings.items()))
+            self.db.execute("INSERT INTO segments VALUES (?)", (segment,))
+        self.segments.add(segment)
+
+    def remove(self, file_paths: Iterable[str]) -> int:
+        """
+        Удаляет документы из индекса; их вхождения пропускаются до compact
+        :returns: сколько документов было в индексе
+        """
+        removed = []
+        with self.db:
+            for file_path in file_paths:
+                row = self.db.execute("SELECT id FROM documents WHERE path = ?", (file_path,)).fetchone()
+                if row is not None:
+                    self.db.execute("DELETE FROM documents WHERE id = ?", row)
+                    removed.append(row)
+            self.db.executemany("INSERT INTO deleted VALUES (?)", removed)
+        self.deleted.update(doc for doc, in removed)
+        return len(removed)
+
+    def _postings(self, word: str) -> Iterator[tuple[int, int]]:
+        """
+        :returns: пары (-частота, id) всех сегментов слова по убыванию частоты, без удалённых
+        """
+        streams = [decode_postings(data) for data, in
+                   self.db.execute("SELECT data FROM postings WHERE word = ?", (word,))]
+        for entry in heapq.merge(*streams):
+            if entry[1] not in self.deleted:
+                yield entry
+
+    def top_documents(self, word: str, n: Optional[int] = 10) -> list[tuple[str, int]]:
+        """
+        :param word: слово (регистр не важен)
+        :param n: кол-во документов, None - все
+        :returns: пары (путь, частота слова) по убыванию частоты, при равенстве в порядке индексации
+        """
+        entries = list(itertools.islice(self._postings(word.lower()), n))
+        paths = {}
+        for start in range(0, len(entries), 500):
+            ids = [doc for _, doc in entries[start:start + 500]]
+            paths.update(self.db.execute(f"SELECT id, path FROM documents WHERE id IN ({','.join('?' * len(ids))})",
+                                         ids))
+        return [(paths[doc], -count) for count, doc in entries]
+
+    def compact(self):
+        """
+        Сливает сегменты каждого слова в один и вычищает вхождения удалённых документов
+        """
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS postings_compact")
+            self.db.execute("""CREATE TABLE postings_compact (
+                word TEXT NOT NULL,
+                segment INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (word, segment)) WITHOUT ROWID""")
+            rows = self.db.execute("SELECT word, data FROM postings ORDER BY word")
+            merged = []
+            for word, group in itertools.groupby(rows, key=lambda row: row[0]):
+                pairs = [(doc, -count) for _, data in group
+                         for count, doc in decode_postings(data) if doc not in self.deleted]
+                if pairs:
+                    merged.append((word, 1, encode_postings(pairs)))
+                if len(merged) >= 10_000:
+                    self.db.executemany("INSERT INTO postings_compact VALUES (?, ?, ?)", merged)
+                    merged = []
+            self.db.executemany("INSERT INTO postings_compact VALUES (?, ?, ?)", merged)
+            self.db.execute("DROP TABLE postings")
+            self.db.execute("ALTER TABLE postings_compact RENAME TO postings")
+            self.db.execute("DELETE FROM deleted")
+            self.db.execute("DELETE FROM segments")
+            self.db.execute("INSERT INTO segments VALUES (1)")
+        self.deleted = set()
+        self.segments = {1}
+
+    def close(self):
+        self.db.close()
+
+
+def get_top_words_corpus(source: str, n: int = 15, workers: Optional[int] = None,
+                         max_in_flight: Optional[int] = None,
+                         chunk_size: Optional[int] = None,
+                         max_words: Optional[int] = None,
+                         cache: Optional[WordCountCache] = None,
+                         use_mmap: bool = False) -> list[tuple[str, int]]:
+    """
+    :param source: директория или glob-шаблон с HTML файлами
+    :param n: кол-во слов
+    :returns: топ-N самых частых слов по всем файлам
+    """
+    word_counts = count_corpus_words(find_html_files(source), workers, max_in_flight, chunk_size,
+                                     max_words, cache, use_mmap)
+    return top_n(word_counts, n)
 
 
 if __name__ == "__main__":
-    file_path = input("Введите путь к HTML файлу: ")
-    if not file_path.endswith(".html"):
-        file_path = file_path.strip() + ".html"
+    parser = argparse.ArgumentParser(description="Топ-N самых частых слов в HTML файлах")
+    parser.add_argument("source", nargs="?", help="HTML файл, директория или glob-шаблон")
+    parser.add_argument("-n", type=int, default=15, help="кол-во слов")
+    parser.add_argument("-j", "--workers", type=int, help="кол-во процессов для корпуса")
+    parser.add_argument("--max-in-flight", type=int, help="максимум файлов в обработке одновременно")
+    parser.add_argument("--chunk-size", type=int, help="читать файлы потоково кусками такого размера")
+    parser.add_argument("--max-words", type=int, help="считать приближённо, храня не больше стольких слов")
+    parser.add_argument("--mmap", action="store_true", help="искать слова в байтах отображённых в память файлов")
+    parser.add_argument("--cache", help="файл SQLite с кэшем частот слов по файлам")
+    parser.add_argument("--cache-max-entries", type=int, help="максимум файлов в кэше")
+    parser.add_argument("--cache-max-bytes", type=int, help="максимальный объём данных в кэше")
+    parser.add_argument("--index", help="файл SQLite с инвертированным индексом: source добавляется в него, "
+                                        "изменённые файлы переиндексируются")
+    parser.add_argument("--word", help="вывести топ-N документов индекса --index с этим словом")
+    parser.add_argument("--metrics", help="записать время этапов в файл: .json - JSON, иначе формат Prometheus "
+                                          "(файлы, посчитанные в процессах пула, не учитываются)")
+    args = parser.parse_args()
+    METRICS.enabled = args.metrics is not None
 
-    while not os.path.exists(file_path):
-        file_path = input("Неверный путь. Введите путь к HTML файлу: ")
+    if args.index:
+        with WordIndex(args.index) as index:
+            if args.source:
+                index.add(find_html_files(args.source), args.workers, args.max_in_flight, args.chunk_size,
+                          args.mmap)
+            top_words = index.top_documents(args.word, args.n) if args.word else []
+    elif args.source is None:
+        file_path = input("Введите путь к HTML файлу: ")
         if not file_path.endswith(".html"):
             file_path = file_path.strip() + ".html"
 
-    top_words = get_top_words(file_path)
+        while not os.path.exists(file_path):
+            file_path = input("Неверный путь. Введите путь к HTML файлу: ")
+            if not file_path.endswith(".html"):
+                file_path = file_path.strip() + ".html"
+
+        top_words = get_top_words(file_path, args.n, args.chunk_size, args.max_words, args.mmap)
+    elif os.path.isfile(args.source) and not args.cache:
+        top_words = get_top_words(args.source, args.n, args.chunk_size, args.max_words, args.mmap)
+    elif args.cache:
+        with WordCountCache(args.cache, args.cache_max_entries, args.cache_max_bytes) as cache:
+            top_words = get_top_words_corpus(args.source, args.n, args.workers, args.max_in_flight,
+                                             args.chunk_size, args.max_words, cache, args.mmap)
+    else:
+        top_words = get_top_words_corpus(args.source, args.n, args.workers, args.max_in_flight,
+                                         args.chunk_size, args.max_words, use_mmap=args.mmap)
 
     for word, count in top_words:
         print(f"{word:<20} {count:>10}")
+
+    if args.metrics:
+        METRICS.export(args.metrics)
@@ -0,0 +1,571 @@
+"""
+Бенчмарки для 1alg.py, 2store.py и 3parse.py на синтетических данных.
+Результат (пропускная способность, перцентили задержки, пиковая память) выводится в JSON.
+peak_mb - пик Python-аллокаций (tracemalloc) при подготовке данных и первом вызове,
+max_rss_mb - пиковый RSS всего процесса.
+
+    python bench.py --output bench.json
+    python bench.py --quick --baseline bench.json   # сравнение с прошлым прогоном
+"""
+import argparse
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import date, timedelta
+from time import perf_counter, sleep
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HTML_FIXTURES = ('site.html', 'string.html', 'juicer.html')
+
+
+def load_module(name: str, file_name: str):
+    """
+    Импортирует модуль из файла, имя которого не является идентификатором (1alg.py и т.п.)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    # Регистрируем до выполнения, чтобы функции модуля можно было передавать в пул процессов
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_benchmark(name: str, setup, op, **params) -> dict:
+    """
+    :param setup: функция без аргументов, возвращает список входов для op
+    :param op: вызывается для каждого входа, время каждого вызова - отдельное измерение
+    :returns: результат для отчёта
+    """
+    # Память меряем отдельно: tracemalloc сильно замедляет код
+    tracemalloc.start()
+    inputs = setup()
+    if inputs:
+        op(inputs[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = []
+    start = perf_counter()
+    for item in inputs:
+        t = perf_counter()
+        op(item)
+        latencies.append(perf_counter() - t)
+    total = perf_counter() - start
+    latencies.sort()
+
+    return {
+        "name": name,
+        "params": params,
+        "ops": len(inputs),
+        "seconds": round(total, 6),
+        "ops_per_sec": round(len(inputs) / total, 3) if total else None,
+        "latency_ms": {q: round(percentile(latencies, p) * 1000, 6)
+                       for q, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "peak_mb": round(peak / 2 ** 20, 3),
+    }
+
+
+# --------------------------------------------------------------------------- 1alg.py
+
+def nested_expression(depth: int, rnd: random.Random) -> str:
+    """(x + (2 * y - (z + (...))))"""
+    expr = rnd.choice("xyz")
+    for _ in range(depth):
+        op = rnd.choice("+-*")
+        expr = f"({rnd.choice('xyz')} {op} {rnd.randint(1, 9)} * {expr})"
+    return expr
+
+
+def polynomial_expression(degree: int, variables: str = "xyz") -> str:
+    """(x + y + z + 1) * ... * (x + y + z + 1), degree множителей"""
+    factor = "(" + " + ".join([*variables, "1"]) + ")"
+    return " * ".join([factor] * degree)
+
+
+def repeated_expression(rnd: random.Random, factors: int = 6) -> str:
+    """(x + 1) * (2 * y - z) * (x + 1) - ...: одни и те же скобки внутри строки и между строками"""
+    groups = ["(x + 1)", "(2 * y - z)", "(x - 3 * z + 1)", "(y + z)"]
+    expr = " * ".join(rnd.choice(groups) for _ in range(factors))
+    return f"{expr} - {rnd.choice(groups)} * {rnd.choice(groups)}"
+
+
+def algebra_benchmarks(scale: float) -> list[dict]:
+    alg = load_module("alg", "1alg.py")
+    rnd = random.Random(1)
+    depth = max(2, int(60 * scale))
+    degree = max(2, int(8 * scale))
+    count = max(10, int(2000 * scale))
+    points = max(1000, int(1_000_000 * scale))
+    evaluate = alg.get_evaluator(polynomial_expression(degree))
+    results = [
+        run_benchmark("algebra.nested", lambda: [nested_expression(rnd.randint(1, depth), rnd) for _ in range(count)],
+                      alg.algebra_calc, depth=depth, count=count),
+        run_benchmark("algebra.polynomial", lambda: [polynomial_expression(d) for d in range(1, degree + 1)],
+                      alg.algebra_calc, degree=degree),
+        run_benchmark("algebra.power", lambda: [f"(x + y + z + 1) ^ {d}" for d in range(1, 5 * degree + 1)],
+                      alg.algebra_calc, degree=5 * degree),
+        run_benchmark("algebra.repeated", lambda: [repeated_expression(rnd) for _ in range(count)],
+                      alg.algebra_calc, count=count),
+        run_benchmark("algebra.get_evaluator", lambda: [polynomial_expression(d % degree + 1) for d in range(count)],
+                      alg.get_evaluator, degree=degree, count=count),
+        run_benchmark("algebra.evaluate.points", lambda: [(rnd.random(), rnd.random(), rnd.random())
+                                                          for _ in range(points)],
+                      lambda point: evaluate(*point), degree=degree, points=points),
+    ]
+    feed = [nested_expression(rnd.randint(1, depth), rnd) for _ in range(max(10, count // 20))]
+    lines = [rnd.choice(feed) for _ in range(count * 10)]
+    results.append(run_benchmark("algebra.batch", lambda: [lines] * 2,
+                                 lambda batch: sum(1 for _ in alg.algebra_calc_batch(iter(batch))),
+                                 depth=depth, lines=len(lines), distinct=len(feed)))
+    if np is not None:
+        arrays = [np.random.default_rng(1).random(points) for _ in range(3)]
+        results.append(run_benchmark("algebra.evaluate.numpy", lambda: [arrays] * 5,
+                                     lambda xyz: evaluate(*xyz), degree=degree, points=points))
+    return results
+
+
+# --------------------------------------------------------------------------- 2store.py
+
+def generate_products(store, count: int, rnd: random.Random) -> list:
+    """
+    Товары со случайным набором свойств Food / Perishable / Vitamins
+    """
+    today = date.today()
+    products = []
+    for i in range(count):
+        name = f"Товар {i}"
+        price = round(rnd.uniform(10, 1000), 2)
+        quantity = rnd.randint(0, 200)
+        food = perishable = vitamins = None
+        kind = rnd.random()
+        if kind < 0.6:
+            food = store.Food(name, price, quantity, proteins=rnd.uniform(0, 30), fats=rnd.uniform(0, 30),
+                              carbs=rnd.uniform(0, 80), calories=rnd.uniform(0, 600))
+            if kind < 0.3:
+                perishable = store.Perishable(name, price, quantity,
+                                              creation_date=today - timedelta(days=rnd.randint(0, 30)),
+                                              shelf_life_days=rnd.randint(1, 30))
+        elif kind < 0.7:
+            vitamins = store.Vitamins(name, price, quantity, without_prescription=rnd.random() < 0.5)
+        products.append(store.CombinedProduct(name, price, quantity, food=food, perishable=perishable,
+                                              vitamins=vitamins))
+    return products
+
+
+def build_storage(store, skus: int, seed: int = 2):
+    storage = store.Storage()
+    for product in generate_products(store, skus, random.Random(seed)):
+        storage.add_product(product)
+    return storage
+
+
+def filled_carts(store, storage, names: list[str], rnd: random.Random, count: int, items: int,
+                 batch: int) -> list[list]:
+    """
+    :returns: пакеты по batch корзин, в каждой до items позиций
+    """
+    carts = []
+    for _ in range(count):
+        cart = store.Cart(storage)
+        cart.set_norms(proteins=100, fats=100, carbs=300, calories=2500)
+        for _ in range(items):
+            cart.add_item(rnd.choice(names), 1, has_prescription=True)
+        carts.append(cart)
+    return [carts[i:i + batch] for i in range(0, count, batch)]
+
+
+def write_catalog_feed(store, path: str, count: int):
+    """
+    CSV-фид из count товаров generate_products
+    """
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(store.CATALOG_FIELDS)
+        for product in generate_products(store, count, random.Random(7)):
+            row = {"name": product.name, "price": product.price, "quantity": product.quantity}
+            if product.is_food():
+                food = product.food
+                row.update(proteins=food.proteins, fats=food.fats, carbs=food.carbs, calories=food.calories)
+            if product.is_perishable():
+                row.update(creation_date=product.perishable.creation_date.isoformat(),
+                           shelf_life_days=product.perishable.shelf_life_days)
+            if product.is_vitamins():
+                row["without_prescription"] = product.vitamins.without_prescription
+            writer.writerow([row.get(field, "") for field in store.CATALOG_FIELDS])
+
+
+def storage_memory(store, skus: int, columnar: bool) -> dict:
+    """
+    Сколько памяти склад удерживает на один товар (вместе с индексами и именами)
+    """
+    tracemalloc.start()
+    storage = store.Storage(columnar=columnar)
+    products = generate_products(store, skus, random.Random(2))
+    for product in products:
+        storage.add_product(product)
+    del products
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "name": "storage.memory." + ("columnar" if columnar else "objects"),
+        "params": {"skus": skus},
+        "bytes_per_sku": round(retained / skus, 1),
+    }
+
+
+def storage_benchmarks(scale: float) -> list[dict]:
+    store = load_module("store", "2store.py")
+    rnd = random.Random(3)
+    skus = max(1000, int(1_000_000 * scale))
+    lookups = max(1000, int(200_000 * scale))
+    carts = max(100, int(5_000 * scale))
+    storage = build_storage(store, skus)
+    names = [f"Товар {rnd.randrange(skus)}" for _ in range(lookups)]
+    # Первый поиск сортирует имена
+    storage.search("")
+
+    def cart_workload(items):
+        cart = store.Cart(storage)
+        cart.set_norms(proteins=100, fats=100, carbs=300, calories=2500)
+        for name, quantity in items:
+            cart.add_item(name, quantity, has_prescription=True)
+        cart.total_cost()
+        cart.total_bju_calories()
+        cart.check_norms()
+
+    results = [
+        run_benchmark("storage.add_product", lambda: generate_products(store, skus, random.Random(4)),
+                      store.Storage().add_product, skus=skus),
+        run_benchmark("storage.get_product", lambda: names, storage.get_product, skus=skus),
+        run_benchmark("storage.cart", lambda: [[(rnd.choice(names), 1) for _ in range(20)] for _ in range(carts)],
+                      cart_workload, skus=skus, carts=carts, items_per_cart=20),
+        run_benchmark("storage.evaluate_carts", lambda: filled_carts(store, storage, names, rnd, carts, 20, 100),
+                      store.evaluate_carts, skus=skus, carts=carts, items_per_cart=20, batch=100),
+        run_benchmark("storage.products_to_restock", lambda: [5] * 5, storage.products_to_restock, skus=skus),
+        run_benchmark("storage.products_to_dispose", lambda: [None] * 5,
+                      lambda _: storage.products_to_dispose(), skus=skus),
+        run_benchmark("storage.products_expiring_within", lambda: [timedelta(hours=24)] * 5,
+                      storage.products_expiring_within, skus=skus),
+        run_benchmark("storage.search.prefix", lambda: [name[:rnd.randint(3, len(name))].lower() for name in names],
+                      storage.search, skus=skus),
+        run_benchmark("storage.search.typo", lambda: [name.replace("Товар", rnd.choice(("Тавар", "товр", "Тоавр")))
+                                                      for name in names[:max(100, lookups // 100)]],
+                      storage.search, skus=skus),
+        storage_memory(store, min(skus, 200_000), columnar=False),
+        storage_memory(store, min(skus, 200_000), columnar=True),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot.bin")
+        results.append(run_benchmark("storage.save_snapshot", lambda: [path] * 3, storage.save_snapshot, skus=skus))
+        results.append(run_benchmark("storage.load_snapshot", lambda: [path] * 3,
+                                     lambda p: store.Storage().load_snapshot(p), skus=skus))
+        durable = store.DurableStorage(os.path.join(directory, "durable"))
+        for product in generate_products(store, 1000, random.Random(4)):
+            durable.add_product(product)
+        results.append(run_benchmark("storage.wal_change_quantity",
+                                     lambda: [f"Товар {rnd.randrange(1000)}" for _ in range(lookups)],
+                                     lambda name: durable.change_quantity(name, 1), ops=lookups))
+        durable.close()
+
+        feed = os.path.join(directory, "feed.csv")
+        write_catalog_feed(store, feed, skus)
+        for workers in (None, 2):
+            results.append(run_benchmark(f"storage.load_catalog.{'pool' if workers else 'serial'}",
+                                         lambda: [feed] * 2,
+                                         lambda p: store.load_catalog(store.Storage(columnar=True), p,
+                                                                      workers=workers),
+                                         rows=skus, workers=workers))
+    return results
+
+
+def run_orders(storage, orders: list[dict], threads: int, payment_s: float,
+               global_lock: bool) -> dict:
+    """
+    threads потоков оформляют заказы: reserve, ожидание оплаты payment_s, commit (каждый 10-й - release).
+    При global_lock весь заказ выполняется под одной общей блокировкой.
+    :returns: задержки заказов и проданные количества
+    """
+    lock = threading.Lock()
+    latencies = [[] for _ in range(threads)]
+    sold = [{} for _ in range(threads)]
+    failed = [0] * threads
+
+    def order(items: dict, index: int, worker: int):
+        reservation, _ = storage.reserve(items)
+        if reservation is None:
+            failed[worker] += 1
+            return
+        sleep(payment_s)
+        if index % 10 == 9:
+            storage.release(reservation)
+            return
+        storage.commit(reservation)
+        for name, quantity in items.items():
+            sold[worker][name] = sold[worker].get(name, 0) + quantity
+
+    def worker(number: int):
+        for index in range(number, len(orders), threads):
+            t = perf_counter()
+            if global_lock:
+                with lock:
+                    order(orders[index], index, number)
+            else:
+                order(orders[index], index, number)
+            latencies[number].append(perf_counter() - t)
+
+    pool = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    start = perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    total = perf_counter() - start
+
+    totals = {}
+    for part in sold:
+        for name, quantity in part.items():
+            totals[name] = totals.get(name, 0) + quantity
+    return {
+        "seconds": total,
+        "latencies": sorted(value for part in latencies for value in part),
+        "sold": totals,
+        "failed": sum(failed),
+    }
+
+
+def concurrency_benchmarks(scale: float) -> list[dict]:
+    """
+    Оформление заказов несколькими потоками: полосы блокировок ConcurrentStorage против одной общей.
+    Из-за GIL выигрыш возможен только пока поток ждёт (оплату), поэтому заказ содержит ожидание.
+    Проверяет, что склад не продал больше, чем было: остатки не отрицательны и сходятся с продажами.
+    """
+    store = load_module("store", "2store.py")
+    rnd = random.Random(5)
+    skus = 200
+    count = max(200, int(4_000 * scale))
+    orders = [{f"Товар {rnd.randrange(skus)}": rnd.randint(1, 3) for _ in range(3)} for _ in range(count)]
+    # Запаса хватает примерно на половину заказов, остальные должны получить отказ
+    stock = max(3, count * 6 // skus // 2)
+    results = []
+    for mode in ("global_lock", "striped"):
+        for threads in (1, 2, 4, 8, 16):
+            storage = store.ConcurrentStorage()
+            for number in range(skus):
+                storage.add_product(store.CombinedProduct(f"Товар {number}", 10.0, stock))
+            run = run_orders(storage, orders, threads, 0.0005, global_lock=mode == "global_lock")
+            oversold = [name for name, product in storage.products.items()
+                        if product.quantity < 0 or product.quantity != stock - run["sold"].get(name, 0)]
+            if oversold:
+                raise AssertionError(f"Остатки разошлись с продажами: {oversold[:5]}")
+            results.append({
+                "name": f"storage.orders.{mode}.{threads}",
+                "params": {"threads": threads, "orders": count, "skus": skus},
+                "ops": count,
+                "seconds": round(run["seconds"], 6),
+                "ops_per_sec": round(count / run["seconds"], 3),
+                "latency_ms": {q: round(percentile(run["latencies"], p) * 1000, 6)
+                               for q, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+                "rejected": run["failed"],
+            })
+    return results
+
+
+async def shoppers(service, store, names: list[str], count: int, visits: int, timeout: float,
+                   rnd: random.Random) -> dict:
+    """
+    count покупателей одновременно: каждый visits раз смотрит товар и кладёт его в корзину,
+    между действиями думает случайное время.
+    :returns: задержки запросов и число запросов, не уложившихся в timeout
+    """
+    latencies = []
+    timeouts = 0
+
+    async def shopper(seed: int):
+        nonlocal timeouts
+        think = random.Random(seed)
+        cart = store.Cart(service.storage)
+        for _ in range(visits):
+            await asyncio.sleep(think.random() * 0.01)
+            name = think.choice(names)
+            for request in (service.get_product(name, timeout=timeout),
+                            service.add_item(cart, name, 1, has_prescription=True, timeout=timeout)):
+                t = perf_counter()
+                try:
+                    await request
+                except asyncio.TimeoutError:
+                    timeouts += 1
+                latencies.append(perf_counter() - t)
+
+    start = perf_counter()
+    await asyncio.gather(*(shopper(rnd.random()) for _ in range(count)))
+    return {"seconds": perf_counter() - start, "latencies": sorted(latencies), "timeouts": timeouts}
+
+
+def async_benchmarks(scale: float) -> list[dict]:
+    """
+    Нагрузка на AsyncStorage: до 10 000 одновременных покупателей в одном цикле событий
+    """
+    store = load_module("store", "2store.py")
+    skus = max(1000, int(100_000 * scale))
+    storage = build_storage(store, skus)
+    names = list(storage.products)
+    results = []
+    for count in sorted({max(100, int(1_000 * scale)), max(100, int(10_000 * scale))}):
+        service = store.AsyncStorage(storage, max_pending=1024)
+        run = asyncio.run(shoppers(service, store, names, count, 5, 1.0, random.Random(6)))
+        requests = len(run["latencies"])
+        results.append({
+            "name": f"storage.async.{count}",
+            "params": {"shoppers": count, "skus": skus, "max_pending": 1024},
+            "ops": requests,
+            "seconds": round(run["seconds"], 6),
+            "ops_per_sec": round(requests / run["seconds"], 3),
+            "latency_ms": {q: round(percentile(run["latencies"], p) * 1000, 6)
+                           for q, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+            "timeouts": run["timeouts"],
+            "requests_per_batch": round(requests / max(1, service.batches), 2),
+        })
+    return results
+
+
+# --------------------------------------------------------------------------- 3parse.py
+
+def scaled_corpus(directory: str, copies: int) -> list[str]:
+    """
+    Для каждой фикстуры создаёт файл из copies её повторений
+    :returns: пути к файлам
+    """
+    paths = []
+    for fixture in HTML_FIXTURES:
+        with open(os.path.join(ROOT, fixture), encoding='utf-8') as file:
+            content = file.read()
+        path = os.path.join(directory, f"x{copies}_{fixture}")
+        with open(path, 'w', encoding='utf-8') as file:
+            for _ in range(copies):
+                file.write(content)
+        paths.append(path)
+    return paths
+
+
+def parse_benchmarks(scale: float) -> list[dict]:
+    parse = load_module("parse", "3parse.py")
+    copies = max(1, int(50 * scale))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = scaled_corpus(directory, copies)
+
+        def read_all():
+            texts = []
+            for path in paths:
+                with open(path, encoding='utf-8') as file:
+                    texts.append(file.read())
+            return texts
+
+        results.append(run_benchmark("parse.remove_html_tags", read_all, parse.remove_html_tags, copies=copies))
+        results.append(run_benchmark("parse.get_words", lambda: [parse.remove_html_tags(t) for t in read_all()],
+                                     parse.get_words, copies=copies))
+        for mode, kwargs in (("read", {}), ("stream", {"chunk_size": 1 << 16}), ("mmap", {"use_mmap": True})):
+            results.append(run_benchmark(f"parse.get_top_words.{mode}", lambda: paths,
+                                         lambda path: parse.get_top_words(path, **kwargs), copies=copies))
+        with parse.WordIndex(os.path.join(directory, "index.db")) as index:
+            # Прогрев уже индексирует файлы: каждый замер удаляет их и индексирует заново
+            results.append(run_benchmark("parse.index.add", lambda: [paths] * 2,
+                                         lambda batch: (index.remove(batch), index.add(batch, workers=1)),
+                                         copies=copies))
+            words = [word for path in paths for word, _ in parse.get_top_words(path, 50)]
+            results.append(run_benchmark("parse.index.top_documents", lambda: words, index.top_documents,
+                                         copies=copies, words=len(words)))
+    return results
+
+
+SUITES = {
+    "algebra": algebra_benchmarks,
+    "storage": storage_benchmarks,
+    "concurrency": concurrency_benchmarks,
+    "async": async_benchmarks,
+    "parse": parse_benchmarks,
+}
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    :returns: описания бенчмарков, пропускная способность которых упала больше чем на tolerance
+    """
+    old = {item["name"]: item for item in baseline}
+    regressions = []
+    for item in results:
+        before = old.get(item["name"])
+        if not before or not before.get("ops_per_sec") or not item.get("ops_per_sec"):
+            continue
+        ratio = item["ops_per_sec"] / before["ops_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append(f"{item['name']}: {before['ops_per_sec']} -> {item['ops_per_sec']} оп/с "
+                               f"({ratio:.2f}x)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки 1alg.py, 2store.py и 3parse.py")
+    parser.add_argument("--only", help="через запятую: " + ", ".join(SUITES))
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель размеров данных")
+    parser.add_argument("--quick", action="store_true", help="то же, что --scale 0.05")
+    parser.add_argument("--output", help="файл для JSON-отчёта, по умолчанию stdout")
+    parser.add_argument("--baseline", help="JSON-отчёт прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое падение пропускной способности")
+    args = parser.parse_args()
+
+    scale = 0.05 if args.quick else args.scale
+    suites = args.only.split(",") if args.only else list(SUITES)
+    results = []
+    for suite in suites:
+        results.extend(SUITES[suite](scale))
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "benchmarks": results,
+    }
+    if resource is not None:
+        report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file)["benchmarks"], args.tolerance)
+        for line in regressions:
+            print("Регрессия:", line, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,314 @@
+"""
+Метрики горячих путей 2store.py и 3parse.py: счётчики, гистограммы задержек и колбэки на отрезки (span).
+Пока METRICS.enabled ложно, ничего не считается: места замеров проверяют флаг и сразу выходят.
+Снимок выгружается в JSON или текстовый формат Prometheus (export).
+Скрипты импортируют модуль как metrics, поэтому каталог репозитория должен быть в sys.path:
+запуск python 2store.py из него или PYTHONPATH с ним при загрузке скриптов по пути.
+"""
+import json
+import os
+from functools import wraps
+from threading import Lock
+from time import perf_counter_ns
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class Counter:
+    """
+    Счётчик с метками: значения меток -> число
+    """
+
+    def __init__(self, name: str, help: str = '', labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], int] = {}
+        self._lock = Lock()
+
+    def inc(self, *labels: str, amount: int = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+
+class HistogramValues:
+    """
+    Распределение значений одной комбинации меток по логарифмически-линейным корзинам, как в HdrHistogram:
+    значения меньше 2 * 2^bits лежат каждое в своей корзине, дальше каждая степень двойки делится
+    на 2^bits корзин, так что относительная погрешность не больше 2^-bits.
+    """
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.count = 0
+        self.sum = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+        # Номер корзины -> кол-во значений
+        self.buckets: Dict[int, int] = {}
+
+    def index(self, value: int) -> int:
+        shift = value.bit_length() - self.bits - 1
+        if shift <= 0:
+            return value
+        return (shift << self.bits) + (value >> shift)
+
+    def bounds(self, index: int) -> Tuple[int, int]:
+        """
+        :returns: наименьшее и наибольшее значения корзины
+        """
+        shift = (index >> self.bits) - 1
+        if shift <= 0:
+            return index, index
+        low = (index - (shift << self.bits)) << shift
+        return low, low + (1 << shift) - 1
+
+    def add(self, value: int):
+        index = self.index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> Optional[int]:
+        """
+        :returns: верхняя граница корзины, в которой лежит q-квантиль (не больше максимума)
+        """
+        if not self.count:
+            return None
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.bounds(index)[1], self.max)
+        return self.max
+
+
+class Histogram:
+    """
+    Гистограмма с метками. Значения - целые числа, per_second штук в секунде (по умолчанию наносекунды),
+    при выгрузке переводятся в секунды.
+    """
+
+    def __init__(self, name: str, help: str = '', labels: Sequence[str] = (), bits: int = 5,
+                 per_second: int = 10 ** 9):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.bits = bits
+        self.per_second = per_second
+        self.values: Dict[Tuple[str, ...], HistogramValues] = {}
+        self._lock = Lock()
+
+    def observe(self, value: int, *labels: str):
+        # HistogramValues.add без лишних вызовов: гистограмма стоит на горячих путях
+        shift = value.bit_length() - self.bits - 1
+        index = value if shift <= 0 else (shift << self.bits) + (value >> shift)
+        with self._lock:
+            values = self.values.get(labels)
+            if values is None:
+                values = self.values[labels] = HistogramValues(self.bits)
+                values.min = values.max = value
+            buckets = values.buckets
+            buckets[index] = buckets.get(index, 0) + 1
+            values.count += 1
+            values.sum += value
+            if value < values.min:
+                values.min = value
+            elif value > values.max:
+                values.max = value
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+
+# Колбэк отрезка: (имя, начало по perf_counter_ns, длительность в нс)
+SpanCallback = Callable[[str, int, int], None]
+
+
+class _Span:
+    def __init__(self, metrics: "Metrics", name: str, histogram: Optional[Histogram]):
+        self.metrics = metrics
+        self.name = name
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.finish_span(self.name, self.start, self.histogram)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Metrics:
+    """
+    Реестр метрик. Отрезок (span) - замер времени блока кода: длительность попадает
+    в гистограмму (по умолчанию span_seconds с меткой span) и передаётся колбэкам span_callbacks,
+    например для трассировки.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: Dict[str, Counter] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.span_callbacks: List[SpanCallback] = []
+        self.spans = self.histogram('span_seconds', 'Длительность отрезков кода', ('span',))
+
+    def counter(self, name: str, help: str = '', labels: Sequence[str] = ()) -> Counter:
+        if name not in self.counters:
+            self.counters[name] = Counter(name, help, labels)
+        return self.counters[name]
+
+    def histogram(self, name: str, help: str = '', labels: Sequence[str] = (), bits: int = 5) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help, labels, bits)
+        return self.histograms[name]
+
+    def span(self, name: str, histogram: Optional[Histogram] = None):
+        """
+        :returns: контекст, замеряющий свой блок; при выключенных метриках - пустой
+        :param histogram: гистограмма с одной меткой, куда писать длительность с меткой name
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, histogram)
+
+    def finish_span(self, name: str, start: int, histogram: Optional[Histogram] = None):
+        duration = perf_counter_ns() - start
+        (histogram or self.spans).observe(duration, name)
+        for callback in self.span_callbacks:
+            callback(name, start, duration)
+
+    def traced(self, name: str, histogram: Optional[Histogram] = None):
+        """
+        Декоратор: каждый вызов функции - отрезок name. Выключенные метрики стоят одной проверки флага.
+        """
+
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.finish_span(name, start, histogram)
+
+            return wrapper
+
+        return decorate
+
+    def reset(self):
+        """
+        Обнуляет значения, оставляя метрики зарегистрированными
+        """
+        for metric in (*self.counters.values(), *self.histograms.values()):
+            metric.reset()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :returns: значения всех метрик; у гистограмм count, sum, min, max и квантили в секундах
+        """
+        counters = {}
+        for counter in self.counters.values():
+            with counter._lock:
+                values = list(counter.values.items())
+            counters[counter.name] = {
+                'help': counter.help,
+                'values': [{'labels': dict(zip(counter.labels, labels)), 'value': value} for labels, value in values],
+            }
+        histograms = {}
+        for histogram in self.histograms.values():
+            second = histogram.per_second
+            rows = []
+            with histogram._lock:
+                for labels, values in histogram.values.items():
+                    row = {'labels': dict(zip(histogram.labels, labels)), 'count': values.count,
+                           'sum': values.sum / second, 'min': values.min / second, 'max': values.max / second}
+                    for key, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+                        row[key] = values.percentile(q) / second
+                    rows.append(row)
+            histograms[histogram.name] = {'help': histogram.help, 'values': rows}
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self) -> str:
+        """
+        :returns: метрики в текстовом формате Prometheus; у гистограмм выводятся только непустые корзины
+        """
+        lines = []
+        for counter in self.counters.values():
+            lines.append(f'# HELP {counter.name} {_escape_help(counter.help)}')
+            lines.append(f'# TYPE {counter.name} counter')
+            with counter._lock:
+                values = list(counter.values.items())
+            for labels, value in values:
+                lines.append(f'{counter.name}{_labels(counter.labels, labels)} {value}')
+        for histogram in self.histograms.values():
+            name, second = histogram.name, histogram.per_second
+            lines.append(f'# HELP {name} {_escape_help(histogram.help)}')
+            lines.append(f'# TYPE {name} histogram')
+            with histogram._lock:
+                for labels, values in histogram.values.items():
+                    cumulative = 0
+                    for index in sorted(values.buckets):
+                        cumulative += values.buckets[index]
+                        le = repr(values.bounds(index)[1] / second)
+                        lines.append(f'{name}_bucket{_labels(histogram.labels, labels, le=le)} {cumulative}')
+                    lines.append(f'{name}_bucket{_labels(histogram.labels, labels, le="+Inf")} {values.count}')
+                    lines.append(f'{name}_sum{_labels(histogram.labels, labels)} {values.sum / second!r}')
+                    lines.append(f'{name}_count{_labels(histogram.labels, labels)} {values.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, fmt: Optional[str] = None):
+        """
+        Записывает снимок метрик в файл атомарно (через временный файл)
+        :param fmt: 'json' или 'prometheus'; по умолчанию по расширению, .json - JSON
+        """
+        if fmt is None:
+            fmt = 'json' if path.endswith('.json') else 'prometheus'
+        if fmt == 'json':
+            data = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        elif fmt == 'prometheus':
+            data = self.to_prometheus()
+        else:
+            raise ValueError(f"Неизвестный формат метрик: {fmt}")
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+# Общий реестр для 2store.py и 3parse.py
+METRICS = Metrics()